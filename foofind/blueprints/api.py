@@ -7,7 +7,7 @@ import zlib
 from flask import Blueprint, abort, request, render_template, current_app, jsonify, url_for, g
 from foofind.utils import mid2url, url2mid, u, logging
 from foofind.services import *
-from foofind.blueprints.files import secure_fill_data, get_file_metadata, DatabaseError, FileNotExist, FileRemoved, FileUnknownBlock
+from foofind.blueprints.files import fill_data_many, get_file_metadata, DatabaseError, FileNotExist, FileRemoved, FileUnknownBlock
 
 
 
@@ -32,7 +32,7 @@ def api_v1():
             s = searchd.search(query, request.args, start=True, group=True, no_group=True)
             ids = list(s.get_results((1.4, 0.1), last_items=[], min_results=100, max_results=100, extra_browse=0))
             stats = s.get_stats()
-            results = enumerate(filter(None, [secure_fill_data(f,text=query) for f in filesdb.get_files(ids,True)]))
+            results = enumerate(filter(None, fill_data_many(filesdb.get_files(ids,True),query)))
             success = True
     except BaseException as e:
         logging.debug(e)
@@ -62,7 +62,7 @@ def api_v2():
             "link": url_for("files.download", file_id=f["view"]["url"], file_name=f["view"]["qfn"]+".htm", _external=True),
             "metadata": {k: (_api_v2_md_parser[k](v) if k in _api_v2_md_parser else v)
                 for k, v in f["view"]["md"].iteritems()},
-            } for f in filter(None, [secure_fill_data(f,text=query) for f in filesdb.get_files(ids,True)])]
+            } for f in filter(None, fill_data_many(filesdb.get_files(ids,True),query))]
         success = True
     return jsonify(
         method = method,
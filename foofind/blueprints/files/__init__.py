@@ -10,11 +10,12 @@ from datetime import datetime
 from timelib import strtotime
 from struct import pack, unpack
 from collections import OrderedDict
+from itertools import izip
 from copy import deepcopy
 from base64 import b64encode, b64decode
 import newrelic.agent
 
-from foofind.blueprints.files.fill_data import secure_fill_data, get_file_metadata, init_data, choose_filename
+from foofind.blueprints.files.fill_data import secure_fill_data, fill_data_many, get_file_metadata, init_data, choose_filename
 from foofind.blueprints.files.helpers import *
 from foofind.services import *
 from foofind.forms.files import SearchForm, CommentForm
@@ -295,25 +296,19 @@ def search_files(query,filters,min_results=0,max_results=30,download=None,last_i
     if not last_items and min_results==0:
         min_results=5
 
-    # obtener los resultados
-    profiler_data={}
-    profiler.checkpoint(profiler_data,opening=["sphinx"])
-
-    s = searchd.search(query, filters=filters, start=not bool(last_items), group=True, no_group=False, order=order)
-    ids = [(bin2hex(fileid), server, sphinxid, weight, sg) for (fileid, server, sphinxid, weight, sg) in s.get_results((1.4, 0.1), last_items=last_items, min_results=min_results, max_results=max_results, extra_browse=0 if max_results>30 else None, weight_processor=weight_processor, tree_visitor=tree_visitor)]
+    # tiempo limite de la peticion: las esperas de la busqueda mas el tiempo para obtener los ficheros
+    deadline = time.time()+((query_time or 0)+extra_wait_time)/1000.+current_app.config["GET_FILES_TIMEOUT"]
 
-    stats = s.get_stats()
-
-    profiler.checkpoint(profiler_data,opening=["entities"], closing=["sphinx"])
-
-    results_entities = list(set(int(aid[4])>>32 for aid in ids if int(aid[4])>>32))
-    ntts = {int(ntt["_id"]):ntt for ntt in entitiesdb.get_entities(results_entities)} if results_entities else {}
-    profiler.checkpoint(profiler_data, closing=["entities"])
-    '''# trae entidades relacionadas
-    if ntts:
-        rel_ids = list(set(eid for ntt in ntts.itervalues() for eids in ntt["r"].itervalues() if "r" in ntt for eid in eids))
-        ntts.update({int(ntt["_id"]):ntt for ntt in entitiesdb.get_entities(rel_ids, None, (False, [u"episode"]))})
-    '''
+    # obtener los resultados, de cache si no se personaliza la ordenacion
+    profiler_data={}
+    search_args = (query, filters, last_items, min_results, max_results, order, weight_processor, tree_visitor)
+    if weight_processor or tree_visitor:
+        search_results = _search_files_results(*search_args, profiler_data=profiler_data, deadline=deadline)
+    else:
+        search_key = (query, tuple(sorted((key, tuple(value) if isinstance(value, list) else value) for key, value in filters.iteritems())),
+                        tuple(last_items), min_results, max_results, order)
+        search_results = resultscache.get(search_key, _search_files_results, search_args, {"profiler_data":profiler_data, "deadline":deadline}, validate=lambda search_results: search_results["stats"]["s"])
+    ids, stats, ntts = search_results["ids"], search_results["stats"], search_results["ntts"]
 
     result = {"time": max(stats["t"].itervalues()) if stats["t"] else 0, "total_found": stats["cs"]}
 
@@ -324,9 +319,7 @@ def search_files(query,filters,min_results=0,max_results=30,download=None,last_i
     else:
         download_id = None
 
-    profiler.checkpoint(profiler_data, opening=["mongo"])
-    files_dict={str(f["_id"]):secure_fill_data(f,text=query,ntts=ntts) for f in get_files(ids,s)}
-    profiler.checkpoint(profiler_data, closing=["mongo"])
+    files_dict={str(f["_id"]):filled for f, filled in izip(search_results["files"], fill_data_many(search_results["files"],query,ntts))}
 
     # añade download a los resultados
     if download_id:
@@ -404,6 +397,38 @@ def search_files(query,filters,min_results=0,max_results=30,download=None,last_i
         "end": stats["end"]
     }
 
+def _search_files_results(query, filters, last_items, min_results, max_results, order, weight_processor, tree_visitor, profiler_data=None, deadline=None):
+    '''
+    Obtiene los resultados de una búsqueda con sus entidades y ficheros, sin depender de la petición actual.
+    Si se da el tiempo limite de la petición, los ficheros se obtienen con el tiempo que quede.
+    '''
+    if profiler_data is None:
+        profiler_data = {}
+
+    profiler.checkpoint(profiler_data,opening=["sphinx"])
+
+    s = searchd.search(query, filters=filters, start=not bool(last_items), group=True, no_group=False, order=order)
+    ids = [(bin2hex(fileid), server, sphinxid, weight, sg) for (fileid, server, sphinxid, weight, sg) in s.get_results((1.4, 0.1), last_items=last_items, min_results=min_results, max_results=max_results, extra_browse=0 if max_results>30 else None, weight_processor=weight_processor, tree_visitor=tree_visitor)]
+
+    stats = s.get_stats()
+
+    profiler.checkpoint(profiler_data,opening=["entities"], closing=["sphinx"])
+
+    results_entities = list(set(int(aid[4])>>32 for aid in ids if int(aid[4])>>32))
+    ntts = entitiesdb.get_entities_by_id(results_entities) if results_entities else {}
+    profiler.checkpoint(profiler_data, closing=["entities"])
+    '''# trae entidades relacionadas
+    if ntts:
+        rel_ids = list(set(eid for ntt in ntts.itervalues() for eids in ntt["r"].itervalues() if "r" in ntt for eid in eids))
+        ntts.update({int(ntt["_id"]):ntt for ntt in entitiesdb.get_entities(rel_ids, None, (False, [u"episode"]))})
+    '''
+
+    profiler.checkpoint(profiler_data, opening=["mongo"])
+    files = list(get_files(ids,s,profiler_data,None if deadline is None else deadline-time.time()))
+    profiler.checkpoint(profiler_data, closing=["mongo"])
+
+    return {"ids":ids, "stats":stats, "ntts":ntts, "files":files}
+
 def download_search(file_data, file_text, fallback):
     '''
     Intenta buscar una cadena a buscar cuando viene download
@@ -522,8 +547,10 @@ def download_file(file_id,file_name=None):
             usersdb.set_file_comment(file_id,current_user,g.lang,form.t.data)
             form.t.data=""
             flash("comment_published_succesfully")
-            #actualizar el fichero con la suma de los comentarios por idioma
-            filesdb.update_file({"_id":file_id,"cs":usersdb.get_file_comments_sum(file_id),"s":file_data["file"]["s"]},direct_connection=True)
+            #actualizar el fichero con la cuenta de los comentarios por idioma
+            comments_sum = usersdb.get_file_comments_sum(file_id)
+            file_data["file"]["cs"] = comments_sum
+            filesdb.update_file({"_id":file_id,"cs":comments_sum,"s":file_data["file"]["s"]},direct_connection=True)
 
         #si tiene comentarios se guarda el número del comentario, el usuario que lo ha escrito, el comentario en si y los votos que tiene
         comments=[]
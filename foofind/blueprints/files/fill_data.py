@@ -3,14 +3,16 @@
     Toda la informacion de un fichero
 '''
 import urllib, re
-from flask import g, Markup
+from hashlib import md5
+from copy import deepcopy
+from flask import g, current_app, Markup
 from flask.ext.babelex import gettext as _
 from urlparse import urlparse
-from itertools import izip_longest, chain
+from itertools import izip_longest, izip, chain
 
 from foofind.services import *
 from foofind.blueprints.files.helpers import *
-from foofind.utils import mid2url, mid2hex, hex2mid, to_seconds, u, logging
+from foofind.utils import mid2url, mid2hex, hex2mid, to_seconds, u, freeze, LRUCache, logging
 from foofind.utils.content_types import *
 from foofind.utils.filepredictor import guess_doc_content_type
 from foofind.datafixes import content_fixes
@@ -46,6 +48,7 @@ def choose_filename(f,text_cache=None):
     if text_cache and text_cache[0] in fns: # Si text es en realidad un ID de fn
         chosen = text_cache[0]
     else:
+        fn_parts_cache = {} # palabras de cada nombre, que puede aparecer en varios origenes
         for hexuri,src in srcs.items():
             if 'bl' in src and src['bl']!=0:
                 continue
@@ -63,27 +66,29 @@ def choose_filename(f,text_cache=None):
 
                 text_weight = 0
                 if text_cache:
-                    fn_parts = slugify(fns[crc]['n']).strip().split(" ")
+                    if crc not in fn_parts_cache:
+                        fn_parts_cache[crc] = slugify(fns[crc]['n']).strip().split(" ")
+                    fn_parts = fn_parts_cache[crc]
 
                     if len(fn_parts)>0:
-                        text_words =  slugify(text_cache[0]).split(" ")
+                        text_positions = text_cache[3]
 
                         # valora numero y orden coincidencias
                         last_pos = -1
                         max_length = length = 0
-                        occurrences = [0]*len(text_words)
+                        occurrences = set()
                         for part in fn_parts:
-                            pos = text_words.index(part) if part in text_words else -1
+                            pos = text_positions.get(part, -1)
                             if pos != -1 and (last_pos==-1 or pos==last_pos+1):
                                 length += 1
                             else:
                                 if length > max_length: max_length = length
                                 length = 0
                             if pos != -1:
-                                occurrences[pos]=1
+                                occurrences.add(pos)
                             last_pos = pos
                         if length > max_length: max_length = length
-                        text_weight = sum(occurrences)*100 + max_length
+                        text_weight = len(occurrences)*100 + max_length
 
                 f['file']['fn'][crc]['tht'] = text_weight
                 better = fns[crc]['c']>max_count
@@ -130,21 +135,133 @@ def choose_filename(f,text_cache=None):
 
     return current_weight>0 # indica si ha encontrado el texto buscado
 
-def build_source_links(f):
+_netloc_re = re.compile(r"^[a-zA-Z0-9+.\-]+://([^/?#]*)")
+_domains = LRUCache(10000)
+
+def get_domain(url):
     '''
-    Construye los enlaces correctamente
+    Devuelve el dominio de una URL, calculado una sola vez para cada host
     '''
-    def get_domain(src):
-        '''
-        Devuelve el dominio de una URL
-        '''
-        url_parts=urlparse(src).netloc.split('.')
+    netloc = _netloc_re.match(url)
+    netloc = netloc.group(1) if netloc else urlparse(url).netloc
+    domain = _domains.get(netloc)
+    if domain is None:
+        url_parts=netloc.split('.')
         i=len(url_parts)-1
         if len(url_parts[i])<=2 and len(url_parts[i-1])<=3:
-            return url_parts[i-2]+'.'+url_parts[i-1]+'.'+url_parts[i]
+            domain = url_parts[i-2]+'.'+url_parts[i-1]+'.'+url_parts[i]
         else:
-            return url_parts[i-1]+'.'+url_parts[i];
+            domain = url_parts[i-1]+'.'+url_parts[i]
+        _domains.set(netloc, domain)
+    return domain
+
+def _source_links_key(source_data):
+    # datos de los que depende la construcción de enlaces de un origen
+    return (source_data.get("d"), tuple(source_data.get("g", ())), "url_pattern" in source_data,
+            source_data.get("url_pattern"), source_data.get("crbl"))
+
+class SourceLinks(object):
+    '''
+    Construcción de los enlaces de un origen, precalculada a partir de sus datos.
+    '''
+    def __init__(self, source_data):
+        self.key = _source_links_key(source_data)
+        self.source_data = source_data
+        self.blocked = "crbl" in source_data and int(source_data["crbl"])==1
+        self.link = None
+        if self.blocked:
+            return
 
+        d = source_data["d"]
+        groups = source_data["g"]
+        self.url_pattern = source_data["url_pattern"] if "url_pattern" in source_data else None
+        self.has_url_pattern = "url_pattern" in source_data
+        self.view_source = "streaming" if "s" in groups else "direct_download" if "w" in groups else "P2P" if "p" in groups else ""
+        self.count_urls = d!="eD2k"
+
+        if "w" in groups or "f" in groups or "s" in groups: #si es descarga directa o streaming
+            self.link = self._web_link
+            self.tip = d
+            self.source = None if "f" in groups else d
+            self.streaming = "s" in groups
+        #torrenthash antes de torrent porque es un caso especifico
+        elif d=="BitTorrentHash":
+            self.link = self._magnet_link
+        elif "t" in groups:
+            self.link = self._torrent_link
+        elif d=="Gnutella":
+            self.link = self._partial_link("xt=urn:sha1:", 0.2, True, True)
+        elif d=="eD2k":
+            self.link = self._ed2k_link
+        elif d=="Tiger":
+            self.link = self._partial_link("xt=urn:tiger:", 0, False, False)
+        elif d=="MD5":
+            self.link = self._partial_link("xt=urn:md5:", 0, False, True)
+
+    def _url(self, src):
+        url = src['url']
+        return url, self.has_url_pattern and not url.startswith(("https://","http://","ftp://"))
+
+    # cada función devuelve peso, tip, nombre del origen, icono, si se usa como grupo (None para no usarlo,
+    # False si no se sustituye el de otro origen), si es descargador, si se unen las partes, contador,
+    # parte del enlace, url y si se usa el patrón del origen
+    def _web_link(self, f, src):
+        url, url_pattern = self._url(src)
+        link_weight = 1
+        #en caso de duda se prefiere streaming
+        if self.streaming:
+            f['view']['action']="listen" if f['view']['ct']==CONTENT_AUDIO else 'watch'
+            link_weight*=2
+        source = get_domain(url) if self.source is None else self.source
+        return link_weight, self.tip, source, "web", True, False, False, 0, "", url, url_pattern
+
+    def _magnet_link(self, f, src):
+        md = f['file']['md']
+        link_weight = 0.7 if 'torrent:tracker' in md or 'torrent:trackers' in md else 0.1
+        part = "xt=urn:btih:"+src['url']
+        if 'torrent:tracker' in md:
+            part += unicode('&tr=' + urllib.quote_plus(u(md['torrent:tracker']).encode("UTF-8")), "UTF-8")
+        elif 'torrent:trackers' in md:
+            trackers = md['torrent:trackers']
+            if isinstance(trackers, basestring):
+                part += unicode("".join('&tr='+urllib.quote_plus(tr) for tr in u(trackers).encode("UTF-8").split(" ")), "UTF-8")
+        # magnet link tiene menos prioridad para el texto
+        return link_weight, "Torrent MagnetLink", "tmagnet", "torrent", False, True, True, int(src['m']), part, "", False
+
+    def _torrent_link(self, f, src):
+        url, url_pattern = self._url(src)
+        tip = get_domain(self.url_pattern%url) if url_pattern else get_domain(url)
+        return 0.8, tip, tip, "torrent", True, True, False, 0, "", url, url_pattern
+
+    def _ed2k_link(self, f, src):
+        url = "ed2k://|file|"+f['view']['pfn']+"|"+str(f['file']['z'] if "z" in f["file"] else 1)+"|"+src['url']+"|/"
+        return 0.1, "eD2k", "ed2k", "ed2k", True, True, False, int(src['m']), "", url, False
+
+    def _partial_link(self, prefix, link_weight, count, group):
+        def link(f, src):
+            return link_weight, "Gnutella", "gnutella", "gnutella", True if group else None, False, True, int(src['m']) if count else 0, prefix+src['url'], "", False
+        return link
+
+_source_links = {}
+
+def get_source_links(source_id, source_data):
+    '''
+    Obtiene la construcción de enlaces de un origen, precalculándola de nuevo si han cambiado sus datos
+    '''
+    source_links = _source_links.get(source_id)
+    # los datos de los origenes se cargan en cada petición, solo se comparan si son otros
+    if source_links is not None and source_links.source_data is source_data:
+        return source_links
+
+    if source_links is None or source_links.key != _source_links_key(source_data):
+        source_links = _source_links[source_id] = SourceLinks(source_data)
+    source_links.source_data = source_data
+    return source_links
+
+def build_source_links(f):
+    '''
+    Construye los enlaces correctamente
+    '''
     f['view']['action']='download'
     f['view']['sources']={}
     max_weight=0
@@ -159,90 +276,22 @@ def build_source_links(f):
         if not src.get('bl',None) in (0, None):
             continue
 
-        url_pattern=downloader=join=False
-        count=0
-        part=url=""
         source_data=g.sources[src["t"]] if "t" in src and src["t"] in g.sources else None
         if source_data is None: #si no existe el origen del archivo
             logging.error("El fichero contiene un origen inexistente en la tabla \"sources\": %s" % src["t"], extra={"file":f})
             if feedbackdb.initialized:
                 feedbackdb.notify_source_error(f['file']["_id"], f['file']["s"])
             continue
-        elif "crbl" in source_data and int(source_data["crbl"])==1: #si el origen esta bloqueado
+
+        source_links = get_source_links(src["t"], source_data)
+        if source_links.blocked or not source_links.link: #si el origen esta bloqueado o no se sabe enlazar
             continue
-        elif "w" in source_data["g"] or "f" in source_data["g"] or "s" in source_data["g"]: #si es descarga directa o streaming
-            link_weight=1
-            tip=source_data["d"]
-            icon="web"
-            source_groups[icon] = tip
-            source=get_domain(src['url']) if "f" in source_data["g"] else source_data["d"]
-            url=src['url']
-            if "url_pattern" in source_data and not url.startswith(("https://","http://","ftp://")):
-                url_pattern=True
-            #en caso de duda se prefiere streaming
-            if "s" in source_data["g"]:
-                f['view']['action']="listen" if f['view']['ct']==CONTENT_AUDIO else 'watch'
-                link_weight*=2
-        #torrenthash antes de torrent porque es un caso especifico
-        elif source_data["d"]=="BitTorrentHash":
-            downloader=True
-            link_weight=0.7 if 'torrent:tracker' in f['file']['md'] or 'torrent:trackers' in f['file']['md'] else 0.1
-            tip="Torrent MagnetLink"
-            source="tmagnet"
-            icon="torrent"
-            if not icon in source_groups:
-                source_groups[icon] = tip # magnet link tiene menos prioridad para el texto
-            join=True
-            count=int(src['m'])
-            part="xt=urn:btih:"+src['url']
-            if 'torrent:tracker' in f['file']['md']:
-                part += unicode('&tr=' + urllib.quote_plus(u(f['file']['md']['torrent:tracker']).encode("UTF-8")), "UTF-8")
-            elif 'torrent:trackers' in f['file']['md']:
-                trackers = f['file']['md']['torrent:trackers']
-                if isinstance(trackers, basestring):
-                    part += unicode("".join('&tr='+urllib.quote_plus(tr) for tr in u(trackers).encode("UTF-8").split(" ")), "UTF-8")
-        elif "t" in source_data["g"]:
-            downloader=True
-            link_weight=0.8
-            url=src['url']
-            if "url_pattern" in source_data and not url.startswith(("https://","http://","ftp://")):
-                url_pattern=True
-                tip=source=get_domain(source_data["url_pattern"]%url)
-            else:
-                tip=source=get_domain(src['url'])
-            icon="torrent"
-            source_groups[icon] = tip
-        elif source_data["d"]=="Gnutella":
-            link_weight=0.2
-            tip="Gnutella"
-            source=icon="gnutella"
-            part="xt=urn:sha1:"+src['url']
-            join=True
-            count=int(src['m'])
-            source_groups[icon] = tip
-        elif source_data["d"]=="eD2k":
-            downloader=True
-            link_weight=0.1
-            tip="eD2k"
-            source=icon="ed2k"
-            url="ed2k://|file|"+f['view']['pfn']+"|"+str(f['file']['z'] if "z" in f["file"] else 1)+"|"+src['url']+"|/"
-            count=int(src['m'])
+
+        link_weight, tip, source, icon, group, downloader, join, count, part, url, url_pattern = source_links.link(f, src)
+        if group:
             source_groups[icon] = tip
-        elif source_data["d"]=="Tiger":
-            link_weight=0
-            tip="Gnutella"
-            source=icon="gnutella"
-            part="xt=urn:tiger:"+src['url']
-            join=True
-        elif source_data["d"]=="MD5":
-            link_weight=0
-            tip="Gnutella"
-            source=icon="gnutella"
-            part="xt=urn:md5:"+src['url']
+        elif group is False and not icon in source_groups:
             source_groups[icon] = tip
-            join=True
-        else:
-            continue
 
         if source in f['view']['sources']:
             view_source = f['view']['sources'][source]
@@ -260,7 +309,7 @@ def build_source_links(f):
         view_source['icon']=icon
         view_source['icons']=source_data.get("icons",False)
         view_source['join']=join
-        view_source['source']="streaming" if "s" in source_data["g"] else "direct_download" if "w" in source_data["g"] else "P2P" if "p" in source_data["g"] else ""
+        view_source['source']=source_links.view_source
         #para no machacar el numero si hay varios archivos del mismo source
         if not 'count' in view_source or count>0:
             view_source['count']=count
@@ -282,7 +331,7 @@ def build_source_links(f):
             elif not "pattern_used" in view_source:
                 view_source['urls'].append(url)
 
-            if source_data["d"]!="eD2k":
+            if source_links.count_urls:
                 view_source['count']+=1
 
         if link_weight>max_weight:
@@ -392,7 +441,6 @@ def format_metadata(f,text_cache, search_text_shown=False):
     '''
     Formatea los metadatos de los archivos
     '''
-    text = text_cache[2] if text_cache else None
     view_md = f['view']['md'] = {}
     view_searches = f["view"]["searches"]={}
     file_type = f['view']['file_type'] if 'file_type' in f['view'] else None
@@ -616,7 +664,6 @@ def format_metadata(f,text_cache, search_text_shown=False):
         except BaseException as e:
             logging.exception("Error obteniendo metadatos especificos del tipo de contenido.")
 
-        view_mdh=f['view']['mdh']={}
         for metadata,value in view_md.items():
             if isinstance(value, basestring):
                 value = clean_html(value)
@@ -625,16 +672,26 @@ def format_metadata(f,text_cache, search_text_shown=False):
                     continue
 
                 view_md[metadata]=value
-
-                # resaltar contenidos que coinciden con la busqueda, para textos no muy largos
-                if len(value)<500:
-                    view_mdh[metadata]=highlight(text,value) if text and len(text)<100 else value
             elif isinstance(value, float): #no hay ningun metadato tipo float
                 view_md[metadata]=str(int(value))
             else:
                 view_md[metadata]=value
     # TODO: mostrar metadatos con palabras buscadas si no aparecen en lo mostrado
 
+def highlight_metadata(f,text_cache):
+    '''
+    Resalta en los metadatos formateados las palabras buscadas
+    '''
+    if not 'md' in f['file']:
+        return
+
+    text = text_cache[2] if text_cache else None
+    view_mdh=f['view']['mdh']={}
+    for metadata,value in f['view']['md'].iteritems():
+        # resaltar contenidos que coinciden con la busqueda, para textos no muy largos
+        if isinstance(value, basestring) and len(value)<500:
+            view_mdh[metadata]=highlight(text,value) if text and len(text)<100 else value
+
 def embed_info(f):
     '''
         Añade la informacion del embed
@@ -695,27 +752,105 @@ def embed_info(f):
         f["view"]["play"]  = (source_data.get("embed_disabled", ""), source_data.get("embed_enabled", ""))
         break
 
-def fill_data(file_data, text=None, ntts={}):
+def prepare_text(text):
     '''
-    Añade los datos necesarios para mostrar los archivos
+    Prepara los datos del texto buscado que se usan al rellenar los datos de los archivos:
+    el texto, su versión normalizada, sus palabras y la primera posición de cada palabra.
     '''
-    if text:
-        slug_text = slugify(text)
-        text = (text, slug_text, frozenset(slug_text.split(" ")))
+    if not text:
+        return None
 
-    # se asegura que esten cargados los datos de origenes y servidor de imagen antes de empezar
-    fetch_global_data()
+    slug_text = slugify(text)
+    text_words = slug_text.split(" ")
+    text_positions = {}
+    for pos, word in enumerate(text_words):
+        text_positions.setdefault(word, pos)
+    return (text, slug_text, frozenset(text_words), text_positions)
+
+def _prepare_file(file_data, text_cache, ntts):
+    '''
+    Inicializa los datos del archivo, elige su tipo y su nombre
+    '''
     f=init_data(file_data, ntts)
     content_fixes(f["file"])
 
     choose_file_type(f)
     # al elegir nombre de fichero, averigua si aparece el texto buscado
-    search_text_shown = choose_filename(f,text)
-    build_source_links(f)
-    embed_info(f)
-    get_images(f)
-    # si hace falta, muestra metadatos extras con el texto buscado
-    format_metadata(f,text, search_text_shown)
+    choose_filename(f,text_cache)
+    return f
+
+# campos de los nombres que choose_filename calcula para cada búsqueda
+_query_fn_fields = frozenset(("c", "tht"))
+
+@unit.observe
+def fragment_key(f):
+    '''
+    Clave de caché de los datos de un archivo que no dependen de la búsqueda. Depende
+    del archivo, el idioma, el nombre elegido y la versión de los datos de los que salen.
+    '''
+    file_data = f["file"]
+    fns = {crc: {key: value for key, value in fn.iteritems() if key not in _query_fn_fields} for crc, fn in file_data["fn"].iteritems()} if "fn" in file_data else None
+    version = md5(repr(freeze([file_data.get("src"), fns] + [file_data.get(field) for field in ("md", "bl", "i", "se", "z")]))).hexdigest()
+    return "file_fragment/%s/%s/%s/%s" % (file_data["id"], getattr(g, "lang", None), f["view"].get("fnid"), version)
+
+@fragment_key.test
+def test():
+    # la clave de los fragmentos no cambia con la búsqueda
+    sample = {"_id": hex2mid("4f1e2d3c4b5a69788796a5b4"), "z": 731906048, "s": 1,
+              "fn": {"1": {"n": "ubuntu-12.04-desktop-i386", "x": "iso"}, "2": {"n": "ubuntu desktop", "x": "iso"}},
+              "src": {"a1b2": {"t": 7, "url": "ubuntu-12.04-desktop-i386.iso", "bl": 0, "fn": {"1": {"m": 5}, "2": {"m": 1}}}},
+              "md": {"torrent:name": "ubuntu-12.04-desktop-i386.iso"}}
+
+    with unit.app.test_request_context():
+        g.keywords = set()
+        g.lang = "en"
+        keys = set()
+        for text in ("ubuntu", "ubuntu 12.04", "desktop i386", "i386 iso", "12.04"):
+            f = init_data(deepcopy(sample))
+            choose_filename(f, prepare_text(text))
+            keys.add(fragment_key(f))
+        assert len(keys)==1, u"Fragment key changes with the query: %s" % ", ".join(keys)
+
+def _complete_file(f, text_cache, fragment=None):
+    '''
+    Completa los datos del archivo con los enlaces, el embed, las imagenes y los metadatos, o
+    con los mismos datos de la caché, y resalta las palabras buscadas en los metadatos.
+
+    @rtype dict
+    @return datos calculados para guardar en caché, o None si se han usado los de la caché
+    '''
+    view = f["view"]
+    if fragment:
+        view.update(fragment)
+        new_fragment = None
+    else:
+        previous = set(view)
+        build_source_links(f)
+        embed_info(f)
+        get_images(f)
+        format_metadata(f,None)
+        new_fragment = {key:value for key, value in view.iteritems() if key not in previous}
+
+    highlight_metadata(f,text_cache)
+    return new_fragment
+
+def fill_data(file_data, text=None, ntts={}):
+    '''
+    Añade los datos necesarios para mostrar los archivos
+    '''
+    text_cache = prepare_text(text)
+
+    # se asegura que esten cargados los datos de origenes y servidor de imagen antes de empezar
+    fetch_global_data()
+    f = _prepare_file(file_data, text_cache, ntts)
+
+    if current_app.config["CACHE_FILES"]:
+        key = fragment_key(f)
+        new_fragment = _complete_file(f, text_cache, cache.get(key))
+        if new_fragment:
+            cache.set(key, new_fragment, timeout=current_app.config["FILE_FRAGMENTS_CACHE_TIMEOUT"])
+    else:
+        _complete_file(f, text_cache)
     return f
 
 def secure_fill_data(file_data,text=None, ntts={}):
@@ -728,6 +863,54 @@ def secure_fill_data(file_data,text=None, ntts={}):
         logging.exception("Fill_data error on file %s: %s"%(str(file_data["_id"]),repr(e)))
         return None
 
+def fill_data_many(files_data, text=None, ntts={}):
+    '''
+    Añade los datos necesarios para mostrar una lista de archivos, preparando una sola vez
+    los datos del texto buscado y los datos globales, y accediendo a la caché de una vez.
+    Los errores se manejan por archivo como en secure_fill_data.
+
+    @type files_data: iterable
+    @param files_data: documentos de los ficheros
+
+    @rtype list
+    @return datos de cada archivo en el mismo orden, o None para los que han fallado
+    '''
+    text_cache = prepare_text(text)
+    fetch_global_data()
+
+    files = []
+    for file_data in files_data:
+        try:
+            files.append((file_data, _prepare_file(file_data, text_cache, ntts)))
+        except BaseException as e:
+            logging.exception("Fill_data error on file %s: %s"%(str(file_data["_id"]),repr(e)))
+            files.append((file_data, None))
+
+    # datos de la caché que no dependen de la búsqueda
+    cache_files = current_app.config["CACHE_FILES"]
+    keys = [fragment_key(f) if f and cache_files else None for file_data, f in files]
+    cached_keys = filter(None, keys)
+    fragments = dict(izip(cached_keys, cache.get_many(*cached_keys))) if cached_keys else {}
+
+    result = []
+    new_fragments = {}
+    for (file_data, f), key in izip(files, keys):
+        if f is None:
+            result.append(None)
+            continue
+        try:
+            new_fragment = _complete_file(f, text_cache, fragments.get(key))
+            if key and new_fragment:
+                new_fragments[key] = new_fragment
+            result.append(f)
+        except BaseException as e:
+            logging.exception("Fill_data error on file %s: %s"%(str(file_data["_id"]),repr(e)))
+            result.append(None)
+
+    if new_fragments:
+        cache.set_many(new_fragments, timeout=current_app.config["FILE_FRAGMENTS_CACHE_TIMEOUT"])
+    return result
+
 def get_file_metadata(file_id, file_name=None):
     '''
     Obtiene el fichero de base de datos y rellena sus metadatos.
@@ -781,7 +964,7 @@ def get_file_metadata(file_id, file_name=None):
 
         file_se = data["se"] if "se" in data else None
 
-        file_ntt = entitiesdb.get_entity(file_se["_id"]) if file_se and "_id" in file_se else None
+        file_ntt = entitiesdb.get_entities_by_id((file_se["_id"],)).get(int(file_se["_id"])) if file_se and "_id" in file_se else None
         ntts = {file_se["_id"]:file_ntt} if file_ntt else {}
 
         '''
@@ -239,7 +239,7 @@ def prepare_args(query=None, filters=None):
 
     g.search_url = url_for('files.search', query="")
 
-def get_files(ids, sphinx_search=None):
+def get_files(ids, sphinx_search=None, profiler_data=None, timeout=None):
     '''
     Recibe lista de tuplas de tamaño 3 o mayor (como las devueltas por search)
     y devuelve los ficheros del mongo correspondiente que no estén bloqueados.
@@ -248,11 +248,17 @@ def get_files(ids, sphinx_search=None):
     @type ids: iterable de tuplas de tamaño 3 o mayor
     @param ids: lista de tuplas (mongoid, id servidor, id sphinx)
 
+    @type profiler_data: dict
+    @param profiler_data: datos de profiling donde añadir tiempos por servidor
+
+    @type timeout: float
+    @param timeout: tiempo que le queda a la petición en segundos
+
     @yield: cada uno de los resultados de los ids en los mongos
 
     '''
     toblock = []
-    for f in filesdb.get_files(ids, servers_known = True, bl = None):
+    for f in filesdb.get_files(ids, servers_known = True, bl = None, timeout = timeout, profiler_data = profiler_data):
         if f["bl"] == 0 or f["bl"] is None:
             yield f
         else:
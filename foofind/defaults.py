@@ -29,13 +29,21 @@ DATA_SOURCE_SERVER_RS = "db"
 DATA_SOURCE_USER = "mongodb://mongo.foofind.com:27017"
 DATA_SOURCE_PAGES = "mongodb://mongo.foofind.com:27017"
 DATA_SOURCE_FEEDBACK = "mongodb://mongo.foofind.com:27017"
+FEEDBACK_QUEUE_SIZE = 10000 # documentos pendientes de guardar, se descartan los mas antiguos
+FEEDBACK_FLUSH_INTERVAL = 1
+FEEDBACK_FLUSH_BATCH = 1000 # documentos pendientes que fuerzan la escritura sin esperar
 DATA_SOURCE_ENTITIES = "mongodb://mongo.foofind.com:27017"
 DATA_SOURCE_DOWNLOADS = "mongodb://mongo.foofind.com:27017"
 DATA_SOURCE_MAX_POOL_SIZE = 50
 DATA_SOURCE_FOO_THREADS = 30
 
 GET_FILES_TIMEOUT = 1
+GET_FILES_MIN_TIMEOUT = 0.2 # tiempo mínimo para obtener los ficheros aunque la petición haya agotado su tiempo
 GET_FILES_POOL_SIZE = 30
+GET_FILES_HEDGE_DELAY = 0.3 # tiempo tras el que se repite la consulta a un servidor lento en otro secundario de su replica set
+GET_FILES_HEDGE_BACKOFF = 60 # tiempo sin usar para consultas de respaldo un secundario que ha fallado
+INDIR_CACHE_SIZE = 200000
+INDIR_CACHE_TIMEOUT = 60*10
 AUTORECONNECT_FOO_INTERVAL = 300
 SECONDARY_ACCEPTABLE_LATENCY_MS = 50
 
@@ -52,9 +60,13 @@ SERVICE_SEARCH_MAINTENANCE_INTERVAL = 1
 SERVICE_SEARCH_PROFILE_INTERVAL = 60
 SERVICE_SPHINX_DISABLE_QUERY_SEARCH = False
 
+SEARCH_QUERY_PLANS_CACHE_SIZE = 5000
+SEARCH_SOURCES_FILTERS_CACHE_SIZE = 500
+
 SEARCH_CONTENT_TYPE_WEIGHTS = {ct:1 for ct in CONTENTS.iterkeys()}
 
 SERVERS_REFRESH_INTERVAL = 60*60 # actualiza servidores cada hora
+SERVERS_STATS_FULL_REFRESH = 24 # recalcula las sumas por origen desde cero cada 24 actualizaciones con cambios
 
 SENTRY_AUTO_LOG_STACKS = True
 SENTRY_DSN = None
@@ -67,8 +79,15 @@ FOODOWNLOADER = False
 DOWNLOADER_UA = ()
 
 CACHE_SEARCHES = True
+RESULTS_CACHE_SIZE = 2000
+RESULTS_CACHE_TIMEOUT = 60 # tiempo que los resultados se consideran actuales
+RESULTS_CACHE_STALE_TIMEOUT = 300 # tiempo que se sirven caducados mientras se refrescan
 CACHE_FILES = True
+FILE_FRAGMENTS_CACHE_TIMEOUT = 60*10 # datos de los ficheros que no dependen de la busqueda
 CACHE_TAMING = True
+ENTITIES_CACHE_SIZE = 20000
+ENTITIES_CACHE_LOCAL_TIMEOUT = 60*5 # tiempo que las entidades se guardan en memoria
+ENTITIES_CACHE_TIMEOUT = 60*60 # tiempo que las entidades se guardan en memcache
 
 CACHE_KEY_PREFIX = "foofind/"
 CACHE_MEMCACHED_SERVERS = ()
@@ -101,6 +120,9 @@ SAFE_ROBOT_USER_AGENTS = [s.strip().replace(" ","_").replace("/", "").replace(".
 ROBOT_USER_AGENTS_RATE_LIMIT = {}
 ROBOT_DEFAULT_RATE_LIMIT = 200
 USER_RATE_LIMIT = 200
+RATE_LIMIT_SYNC_BATCH = 10 # peticiones de un cliente que se cuentan en local antes de sumarlas en memcache
+RATE_LIMIT_SYNC_INTERVAL = 5
+RATE_LIMIT_CLIENTS = 50000
 
 
 PROFILER_GRAPHS = { 1:("Search page", 'TIMING', ["taming","mongo","sphinx","visited","entities"]),
@@ -115,7 +137,17 @@ PROFILER_GRAPHS = { 1:("Search page", 'TIMING', ["taming","mongo","sphinx","visi
                     10:("Search waiting timeouts", 'SUM', ["sp_timeout%d"%s for s in xrange(1,20)]),
                     11:("Bots results", 'SUM', ["bot_%s"%s for s in SAFE_ROBOT_USER_AGENTS]),
                     12:("Bots not results", 'SUM', ["bot_no_%s"%s for s in SAFE_ROBOT_USER_AGENTS]),
-                    13:("Downloader", 'SUM', ["downloader_opened"])
+                    13:("Downloader", 'SUM', ["downloader_opened"]),
+                    14:("Query plans cache", 'SUM', ["qp_hits","qp_misses","qp_evictions"]),
+                    15:("Query plans cache size", 'MEAN', ["qp_size"]),
+                    16:("Search results cache", 'SUM', ["rc_hits","rc_stale_hits","rc_misses","rc_refreshes","rc_errors"]),
+                    17:("Search results cache staleness", 'MEAN', ["rc_staleness","rc_size"]),
+                    18:("Mongo files accesses", 'TIMING', ["mongo%ds"%s for s in xrange(1,20)]+["mongo%dh"%s for s in xrange(1,20)]),
+                    19:("Mongo timeouts and errors", 'SUM', ["mongo%dt"%s for s in xrange(1,20)]+["mongo%de"%s for s in xrange(1,20)]),
+                    20:("Entities cache", 'SUM', ["ntt_local_hits","ntt_local_misses","ntt_cache_hits","ntt_cache_misses","ntt_db_found","ntt_db_missing"]),
+                    21:("Entities cache size", 'MEAN', ["ntt_local_size"]),
+                    22:("Feedback queue", 'SUM', ["fb_queued","fb_written","fb_dropped","fb_errors"]),
+                    23:("Feedback queue size", 'MEAN', ["fb_pending"])
                     }
 
 OAUTH_TWITTER_CALLBACK_URL = "http://foofind.com/es/user/oauth/tw/callback"
@@ -16,11 +16,12 @@ from foofind.services.db.downloadstore import DownloadStore
 from foofind.services.db.pluginstore import PluginStore
 from foofind.utils.profiler import Profiler
 from foofind.utils.event import EventManager
+from foofind.utils.warmcache import WarmCache
 from foofind.utils.taming import TamingClient
 from extensions import *
 
 __all__=['filesdb', 'usersdb', 'pagesdb', 'feedbackdb', 'configdb', 'entitiesdb',
-                'taming', 'eventmanager', 'profiler', 'searchd', 'downloadsdb', 'plugindb']
+                'taming', 'eventmanager', 'profiler', 'searchd', 'downloadsdb', 'plugindb', 'resultscache']
 
 __all__.extend(extensions.__all__)
 
@@ -36,3 +37,4 @@ taming = TamingClient()
 eventmanager = EventManager()
 profiler = Profiler()
 searchd = Searchd()
+resultscache = WarmCache()
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 import pymongo
+from time import time
 from foofind.services.extensions import cache
-from foofind.utils import logging
+from foofind.utils import LRUCache, logging
+
+# valor guardado para las entidades inexistentes, para no volver a consultarlas hasta que caduquen
+MISSING_ENTITY = {}
 
 class EntitiesStore(object):
     '''
@@ -13,6 +17,9 @@ class EntitiesStore(object):
         '''
         self.entities_conn = None
         self.enabled = False
+        self.entities_cache = LRUCache(1)
+        self.local_timeout = self.cache_timeout = 0
+        self._reset_stats()
 
     def init_app(self, app):
         '''
@@ -20,6 +27,10 @@ class EntitiesStore(object):
 
         @param app: Flask application.
         '''
+        self.entities_cache = LRUCache(app.config["ENTITIES_CACHE_SIZE"])
+        self.local_timeout = app.config["ENTITIES_CACHE_LOCAL_TIMEOUT"]
+        self.cache_timeout = app.config["ENTITIES_CACHE_TIMEOUT"]
+
         if app.config["DATA_SOURCE_ENTITIES"]:
             try:
                 if "DATA_SOURCE_ENTITIES_RS" in app.config:
@@ -43,6 +54,81 @@ class EntitiesStore(object):
             self.entities_conn = entities_conn
             self.enabled = True
 
+    def _reset_stats(self):
+        self.local_hits = self.local_misses = self.cache_hits = self.cache_misses = self.db_found = self.db_missing = 0
+
+    def get_entities_by_id(self, entities_ids):
+        '''
+        Obtiene varias entidades por identificador, buscando cada una primero en memoria,
+        después en memcache y por último en la base de datos con una sola consulta.
+
+        @type entities_ids: iterable
+        @param entities_ids: ids de las entidades
+
+        @rtype: dict
+        @return: entidades encontradas por id
+        '''
+        result = {}
+        now = time()
+
+        # memoria local
+        pending = []
+        for entity_id in set(int(entity_id) for entity_id in entities_ids):
+            entry = self.entities_cache.get(entity_id)
+            if entry and entry[1]>now:
+                if entry[0]:
+                    result[entity_id] = entry[0]
+            else:
+                pending.append(entity_id)
+        self.local_hits += len(result)
+        self.local_misses += len(pending)
+        if not pending:
+            return result
+
+        # memcache
+        expires = now+self.local_timeout
+        missing = []
+        for entity_id, entity in zip(pending, cache.get_many(*("ntt/%d"%entity_id for entity_id in pending))):
+            if entity is None:
+                missing.append(entity_id)
+                continue
+            self.entities_cache.set(entity_id, (entity, expires))
+            if entity:
+                result[entity_id] = entity
+        self.cache_hits += len(pending)-len(missing)
+        self.cache_misses += len(missing)
+        if not missing or not self.enabled:
+            return result
+
+        # base de datos
+        try:
+            found = {int(entity["_id"]):entity for entity in self.entities_conn.ontology.ontology.find({"_id":{"$in":missing}})}
+            self.entities_conn.end_request()
+        except BaseException as e:
+            logging.warn("Can't access to entities database. Entities disabled.")
+            self.enabled = False
+            return result
+
+        loaded = {entity_id:found.get(entity_id, MISSING_ENTITY) for entity_id in missing}
+        cache.set_many({"ntt/%d"%entity_id:entity for entity_id, entity in loaded.iteritems()}, timeout=self.cache_timeout)
+        for entity_id, entity in loaded.iteritems():
+            self.entities_cache.set(entity_id, (entity, expires))
+        self.db_found += len(found)
+        self.db_missing += len(missing)-len(found)
+        result.update(found)
+        return result
+
+    def save_profile_info(self, profiler):
+        '''
+        Guarda los aciertos y fallos de cada nivel del cargador de entidades.
+        '''
+        profiling_info = {"ntt_local_hits": self.local_hits, "ntt_local_misses": self.local_misses,
+                          "ntt_cache_hits": self.cache_hits, "ntt_cache_misses": self.cache_misses,
+                          "ntt_db_found": self.db_found, "ntt_db_missing": self.db_missing,
+                          "ntt_local_size": len(self.entities_cache)}
+        self._reset_stats()
+        profiler.save_data(profiling_info)
+
     @cache.memoize(timeout=60*60)
     def get_entity(self, entity_id):
         '''
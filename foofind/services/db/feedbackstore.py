@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import pymongo
-from foofind.utils import hex2mid, check_capped_collections
+import threading
+from collections import deque, defaultdict
+from foofind.utils import hex2mid, check_capped_collections, logging
 from hashlib import sha256
 from datetime import datetime
 from time import time
@@ -20,14 +22,29 @@ class FeedbackStore(object):
         Inicialización de la clase.
         '''
         self.feedback_conn = None
+        self.eventmanager = None
         self.initialized = False
 
-    def init_app(self, app):
+        # cola de escrituras diferidas
+        self.flush_interval = 1
+        self.flush_batch = 1000
+        self._queue = deque(maxlen=10000)
+        self._queue_lock = threading.Lock()
+        self._reset_stats()
+
+    def init_app(self, app, eventmanager):
         '''
         Apply users database access configuration.
 
         @param app: Flask application.
+        @param eventmanager: event manager used to flush the write queue.
         '''
+        self._queue = deque(maxlen=app.config["FEEDBACK_QUEUE_SIZE"])
+        self.flush_interval = app.config["FEEDBACK_FLUSH_INTERVAL"]
+        self.flush_batch = app.config["FEEDBACK_FLUSH_BATCH"]
+        self.eventmanager = eventmanager
+        eventmanager.interval(self.flush_interval, self.flush)
+
         if app.config["DATA_SOURCE_FEEDBACK"]:
             self.feedback_conn = pymongo.MongoClient(app.config["DATA_SOURCE_FEEDBACK"], max_pool_size=app.config["DATA_SOURCE_MAX_POOL_SIZE"], slave_okay=True)
 
@@ -56,31 +73,95 @@ class FeedbackStore(object):
         self.feedback_conn.feedback.links.insert({"links":data["links"],"ip":sha256(data["ip"]).hexdigest(),"created": datetime.utcnow()})
         self.feedback_conn.end_request()
 
+    def _reset_stats(self):
+        self.queued = self.written = self.dropped = self.errors = 0
+
+    def _enqueue(self, collection, documents):
+        '''
+        Añade documentos a la cola de escrituras diferidas. Si la cola está llena
+        se descartan los más antiguos.
+
+        @type collection: str
+        @param collection: nombre de la colección de destino
+
+        @type documents: list
+        @param documents: documentos a insertar
+        '''
+        with self._queue_lock:
+            overflow = len(self._queue)+len(documents)-self._queue.maxlen
+            if overflow>0:
+                self.dropped += overflow
+            previous = len(self._queue)
+            self._queue.extend((collection, document) for document in documents)
+            self.queued += len(documents)
+            pending = len(self._queue)
+
+        # al llegar al tamaño de lote se escribe sin esperar al siguiente intervalo
+        if previous<self.flush_batch<=pending and self.eventmanager:
+            self.eventmanager.timeout(0, self.flush)
+
+    def flush(self):
+        '''
+        Escribe en la base de datos los documentos pendientes, con una inserción por colección.
+        '''
+        with self._queue_lock:
+            if not self._queue or not self.initialized:
+                return
+            pending = list(self._queue)
+            self._queue.clear()
+
+        documents = defaultdict(list)
+        for collection, document in pending:
+            documents[collection].append(document)
+
+        written = errors = 0
+        for collection, docs in documents.iteritems():
+            try:
+                # los duplicados no interrumpen la escritura del resto de documentos
+                self.feedback_conn.feedback[collection].insert(docs, continue_on_error=True)
+                written += len(docs)
+            except pymongo.errors.DuplicateKeyError:
+                written += len(docs)
+            except BaseException as e:
+                errors += len(docs)
+                logging.warn("Can't save feedback data in %s: %s" % (collection, e))
+        self.feedback_conn.end_request()
+
+        with self._queue_lock:
+            self.written += written
+            self.errors += errors
+
+    def save_queue_stats(self, profiler):
+        '''
+        Guarda los contadores de la cola de escrituras diferidas.
+        '''
+        with self._queue_lock:
+            profiling_info = {"fb_queued": self.queued, "fb_written": self.written, "fb_dropped": self.dropped,
+                              "fb_errors": self.errors, "fb_pending": len(self._queue)}
+            self._reset_stats()
+        profiler.save_data(profiling_info)
+
     def notify_indir(self, file_id, server=None):
         '''
         Guarda un id de fichero en la tabla de errores de indir
         '''
-        self.feedback_conn.feedback.notify_indir.insert({"_id":file_id,"s":server})
-        self.feedback_conn.end_request()
+        self._enqueue("notify_indir", ({"_id":file_id,"s":server},))
 
     def notify_source_error(self, file_id, server):
         '''
         Guarda un id de fichero, y servidor, en la tabla de errores de source
         '''
-        self.feedback_conn.feedback.notify_source.insert({"_id":file_id,"s":server})
-        self.feedback_conn.end_request()
+        self._enqueue("notify_source", ({"_id":file_id,"s":server},))
 
     def visited_links(self,links):
         '''
         Guarda los enlaces visitados en la búsqueda
         '''
-        self.feedback_conn.feedback.visited_links.insert(links)
-        self.feedback_conn.end_request()
+        self._enqueue("visited_links", links if isinstance(links, list) else (links,))
 
     def save_profile_info(self, info):
         info["_date"] = time()
-        self.feedback_conn.feedback.profiler.insert(info)
-        self.feedback_conn.end_request()
+        self._enqueue("profiler", (info,))
 
     def get_profile_info(self, start):
         cursor = self.feedback_conn.feedback.profiler.find({"_date":{"$gt":start}})
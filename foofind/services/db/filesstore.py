@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import pymongo, time, traceback, bson
+from Queue import Queue, Empty
 from collections import defaultdict, OrderedDict
 from threading import Lock, Event
 from itertools import permutations
@@ -7,11 +8,12 @@ from datetime import datetime
 from multiprocessing.pool import ThreadPool, TimeoutError
 
 import foofind.services
-from foofind.utils import hex2mid, u, Parallel, logging
+from foofind.utils import hex2mid, u, Parallel, logging, LRUCache
 from foofind.utils.async import MultiAsync
 from foofind.services.extensions import cache
 
 profiler = None
+
 class MongoTimeout(Exception):
     '''
     Fallo de conexión de mongo
@@ -39,11 +41,25 @@ class FilesStore(object):
         '''
         self.max_pool_size = app.config["DATA_SOURCE_MAX_POOL_SIZE"]
         self.get_files_timeout = app.config["GET_FILES_TIMEOUT"]
+        self.get_files_min_timeout = app.config["GET_FILES_MIN_TIMEOUT"]
         self.max_autoreconnects = app.config["MAX_AUTORECONNECTIONS"]
         self.secondary_acceptable_latency_ms = app.config["SECONDARY_ACCEPTABLE_LATENCY_MS"]
 
         self.thread_pool_size = app.config["GET_FILES_POOL_SIZE"]
         self.thread_pool = None
+        self.get_files_hedge_delay = app.config["GET_FILES_HEDGE_DELAY"]
+
+        # conexiones directas a secundarios para las consultas de respaldo, ultimo miembro que ha respondido
+        # a cada servidor, turno para repartir las consultas de respaldo y secundarios que han fallado
+        self.get_files_hedge_backoff = app.config["GET_FILES_HEDGE_BACKOFF"]
+        self.hedge_conns = {}
+        self.servers_last_member = {}
+        self.hedge_turn = defaultdict(int)
+        self.hedge_failures = {}
+
+        # cache de indir: servidor e id de destino por id binario de fichero
+        self.indir_cache = LRUCache(app.config["INDIR_CACHE_SIZE"])
+        self.indir_cache_timeout = app.config["INDIR_CACHE_TIMEOUT"]
 
         self.replica_set = app.config["DATA_SOURCE_SERVER_RS"]
         self.replica_set_tag_sets = app.config.get("DATA_SOURCE_SERVER_RS_TAG_SETS",[{}])
@@ -66,31 +82,198 @@ class FilesStore(object):
             if self.current_server < server_id:
                 self.current_server = server_id
 
+    def _hedge_member(self, sid):
+        '''
+        Elige un secundario del replica set de un servidor para una consulta de respaldo, preferiblemente
+        distinto del último que ha respondido al cliente del replica set y sin fallos recientes.
+        Nunca elige el primario. Crea la conexión directa al secundario sin conectar, por lo que la
+        primera consulta está limitada por connectTimeoutMS y no se bloquea el hilo de la petición.
+
+        @type sid: str
+        @param sid: id de servidor de archivos
+
+        @rtype tuple
+        @return host y puerto del secundario o None si no hay otro secundario disponible
+        '''
+        now = time.time()
+        members = sorted(member for member in getattr(self.servers_conn[sid], "secondaries", None) or ()
+                            if self.hedge_failures.get(member, 0)<now)
+
+        # el cliente del replica set puede haber cambiado de miembro, si no queda otro se prueba con él
+        last_member = self.servers_last_member.get(sid)
+        if len(members)>1 and last_member in members:
+            members.remove(last_member)
+        if not members:
+            return None
+
+        turn = self.hedge_turn[sid] = (self.hedge_turn[sid]+1)%len(members)
+        member = members[turn]
+        if member not in self.hedge_conns:
+            timeout_ms = int(self.get_files_timeout*1000)
+            self.hedge_conns.setdefault(member, pymongo.MongoClient(member[0], member[1], max_pool_size=self.max_pool_size,
+                                                connectTimeoutMS=timeout_ms, socketTimeoutMS=timeout_ms,
+                                                read_preference=pymongo.read_preferences.ReadPreference.SECONDARY,
+                                                _connect=False))
+        return member
+
     def _get_server_files(self, params):
         '''
-        Usado por el MultiAsync en get_files
+        Usado por el pool de hilos en get_files
 
         Recupera los datos de los ficheros con los ids dados del
-        servidor mongo indicado por sid y los devuelve a través
-        del objeto async.
+        servidor mongo indicado por sid, sin pasar del tiempo límite.
 
-        @param async: objeto async
         @type sid: str
         @param sid: id de servidor de archivos
         @type ids: list
         @param ids: lista de ids a obener
-        '''
-        sid, ids, bl = params
-        data = tuple(
-            self.servers_conn[sid].foofind.foo.find(
+        @type deadline: float
+        @param deadline: momento limite para obtener los datos
+        @type member: tuple o None
+        @param member: secundario al que lanzar una consulta de respaldo, None para usar el cliente del replica set
+        '''
+        sid, ids, bl, deadline, member = params
+        remaining = deadline-time.time()
+        if remaining<=0:
+            return ()
+
+        # el servidor aborta la consulta y el socket deja de esperar al llegar al tiempo límite
+        cursor = (self.hedge_conns[member] if member else self.servers_conn[sid]).foofind.foo.find(
                 {"_id": {"$in": ids}}
                 if bl is None else
-                {"_id": {"$in": ids},"bl":bl}))
+                {"_id": {"$in": ids},"bl":bl}, network_timeout=remaining)
+        cursor.max_time_ms(max(1, int(remaining*1000)))
+
+        data = tuple(cursor)
+        if not member:
+            # miembro elegido por el cliente del replica set, las consultas de respaldo van a otro
+            self.servers_last_member[sid] = getattr(cursor, "conn_id", None)
         for doc in data:
             doc["s"] = sid
         return data
 
-    def get_files(self, ids, servers_known = False, bl = 0):
+    def _timed_server_files(self, params):
+        '''
+        Usado por el pool de hilos en get_files
+
+        Devuelve el servidor, el secundario de la consulta de respaldo o None, el tiempo empleado
+        y los datos obtenidos o None si ha fallado.
+        '''
+        start = time.time()
+        try:
+            data = self._get_server_files(params)
+        except BaseException as e:
+            # las consultas que agotan el tiempo se registran al terminar get_files
+            if time.time()<params[3]:
+                logging.warn("Error getting files from server %s: %s"%(params[0], repr(e)))
+            # no se usa el secundario para otras consultas de respaldo durante un tiempo
+            if params[4]:
+                self.hedge_failures[params[4]] = time.time()+self.get_files_hedge_backoff
+            data = None
+        return params[0], params[4], time.time()-start, data
+
+    def _fan_out_files(self, sids, bl, deadline, profiler_data):
+        '''
+        Obtiene los ficheros de uno o varios servidores en paralelo.
+
+        Cada servidor se consulta con el cliente de su replica set, que respeta su preferencia de
+        lectura. Los servidores que tardan más de GET_FILES_HEDGE_DELAY se consultan de nuevo
+        directamente en otro secundario y se usa la primera respuesta. Las consultas tienen el tiempo
+        límite como timeout, por lo que las que no responden antes liberan su hilo al llegar a él.
+        '''
+        # crea el pool de hilos si no existe
+        if not self.thread_pool:
+            self.thread_pool = ThreadPool(processes=self.thread_pool_size)
+
+        responses = Queue()
+        def request(sid, member):
+            self.thread_pool.apply_async(self._timed_server_files, ((sid, sids[sid], bl, deadline, member),), callback=responses.put)
+
+        for sid in sids:
+            request(sid, None)
+
+        results = []
+        pending = {sid:1 for sid in sids} # consultas en curso por servidor
+        hedge_time = time.time()+self.get_files_hedge_delay if self.get_files_hedge_delay else deadline
+        while pending:
+            now = time.time()
+            if now>=deadline:
+                break
+
+            # lanza las consultas de respaldo para los servidores que tardan
+            if now>=hedge_time:
+                for sid in pending.iterkeys():
+                    member = self._hedge_member(sid)
+                    if member:
+                        pending[sid] += 1
+                        request(sid, member)
+                hedge_time = deadline
+
+            try:
+                sid, member, elapsed, data = responses.get(True, min(hedge_time, deadline)-now)
+            except Empty:
+                continue
+
+            # ignora las respuestas de servidores ya obtenidos
+            if sid not in pending:
+                continue
+
+            if data is None: # ha fallado, espera a la otra consulta si la hay
+                pending[sid] -= 1
+                if not pending[sid]:
+                    del pending[sid]
+                    profiler_data["mongo%se"%sid] = 1
+                continue
+
+            del pending[sid]
+            results.extend(data)
+
+            # tiempos de consultas y de consultas de respaldo por servidor
+            if member:
+                profiler_data["mongo%sh"%sid] = elapsed
+            else:
+                profiler_data["mongo%ss"%sid] = elapsed
+
+        # servidores descartados por tiempo
+        for sid in pending:
+            profiler_data["mongo%st"%sid] = 1
+        if pending:
+            logging.warn("Timeout getting files from servers %s."%", ".join(pending))
+
+        return results
+
+    def _get_indir(self, fids):
+        '''
+        Averigua en qué servidor está cada fichero y si apunta a otro id.
+        Usa el cache local de indir y consulta los que falten en una sola petición.
+
+        @type fids: iterable
+        @param fids: ids de ficheros
+
+        @rtype dict
+        @return Tuplas (servidor, id de destino o None) por id de fichero, sin los ficheros que no están en indir
+        '''
+        now = time.time()
+        results = {}
+        misses = []
+        for fid in fids:
+            entry = self.indir_cache.get(fid.binary)
+            if entry and entry[2]>now:
+                results[fid] = entry[:2]
+            else:
+                misses.append(fid)
+
+        if misses:
+            expires = now+self.indir_cache_timeout
+            for ind in self.server_conn.foofind.indir.find({"_id": {"$in": misses}, "s": {"$exists": 1}}):
+                ind_server = str(int(ind["s"])) if ind["s"] else None # Bug en indir: 's' como float
+                ind_target = ind.get("t", None)
+                self.indir_cache.set(ind["_id"].binary, (ind_server, ind_target, expires))
+                results[ind["_id"]] = (ind_server, ind_target)
+            self.server_conn.end_request()
+        return results
+
+    def get_files(self, ids, servers_known = False, bl = 0, timeout = None, profiler_data = None):
         '''
         Devuelve los datos de los ficheros correspondientes a los ids
         dados en formato hexadecimal.
@@ -102,12 +285,21 @@ class FilesStore(object):
         @type bl: int o None
         @param bl: valor de bl para buscar, None para no restringir
 
+        @type timeout: float
+        @param timeout: tiempo que le queda a la petición en segundos, por defecto GET_FILES_TIMEOUT
+
+        @type profiler_data: dict
+        @param profiler_data: datos de profiling donde añadir tiempos y fallos por servidor
+
         @rtype generator
         @return Generador con los documentos de ficheros
         '''
 
         if not ids: return ()
 
+        # el tiempo disponible de la petición no supera GET_FILES_TIMEOUT ni baja de GET_FILES_MIN_TIMEOUT
+        deadline = time.time()+(self.get_files_timeout if timeout is None else max(self.get_files_min_timeout, min(self.get_files_timeout, timeout)))
+
         sids = defaultdict(list)
         # si conoce los servidores en los que están los ficheros,
         # se analiza ids como un iterable (id, servidor, ...)
@@ -117,44 +309,17 @@ class FilesStore(object):
                 sids[x[1]].append(hex2mid(x[0]))
         else:
             # averigua en qué servidor está cada fichero
-            nindir = self.server_conn.foofind.indir.find({"_id": {"$in": [hex2mid(fid) for fid in ids]}, "s": {"$exists": 1}})
-            for ind in nindir:
-                indserver = str(int(ind["s"])) # Bug en indir: 's' como float
+            for fid, (indserver, target) in self._get_indir([hex2mid(fid) for fid in ids]).iteritems():
                 if indserver in self.servers_conn:
-                    if "t" in ind: # si apunta a otro id, lo busca en vez del id dado
-                        sids[indserver].append(ind["t"])
-                    else:
-                        sids[indserver].append(ind["_id"])
-            self.server_conn.end_request()
+                    # si apunta a otro id, lo busca en vez del id dado
+                    sids[indserver].append(fid if target is None else target)
 
-        lsids = len(sids)
-        if lsids == 0:
+        if not sids:
             # Si no hay servidores, no hay ficheros
             return ()
-        elif lsids == 1:
-            k, v = sids.iteritems().next()
-            return self._get_server_files((k, v, bl))
-        else:
-            # crea el pool de hilos si no existe
-            if not self.thread_pool:
-                self.thread_pool = ThreadPool(processes=self.thread_pool_size)
-
-            # obtiene la información de los ficheros de cada servidor
-            results = []
-            chunks = self.thread_pool.imap_unordered(self._get_server_files, ((k, v, bl) for k, v in sids.iteritems()))
-            end = time.time()+self.get_files_timeout
-            try:
-                for i in xrange(len(sids)):
-                    now = time.time()
-                    if now>end:
-                        break
-                    for r in chunks.next(end-now):
-                        results.append(r)
-            except TimeoutError:
-                pass
-            except BaseException as e:
-                logging.error("Error on get_files.")
-            return results
+
+        # obtiene la información de los ficheros de cada servidor
+        return self._fan_out_files(sids, bl, deadline, {} if profiler_data is None else profiler_data)
 
     def get_file(self, fid, sid=None, bl=0):
         '''
@@ -174,16 +339,15 @@ class FilesStore(object):
         '''
         if sid is None:
             # averigua en qué servidor está el fichero
-            ind = self.server_conn.foofind.indir.find_one({"_id":fid})
+            ind = self._get_indir((fid,)).get(fid)
             # Verificación para evitar basura de indir
-            if ind is None or not "s" in ind or not ind["s"]:
+            if ind is None or not ind[0]:
                 return None
-            sid = str(int(ind["s"]))
+            sid, target = ind
             if not sid in self.servers_conn:
                 return None
-            if "t" in ind:
-                fid = ind["t"]
-            self.server_conn.end_request()
+            if target is not None:
+                fid = target
 
         data = self.servers_conn[sid].foofind.foo.find_one(
             {"_id":fid} if bl is None else
@@ -516,6 +680,21 @@ class FilesStore(object):
         self.server_conn.end_request()
         return data
 
+    @cache.memoize(timeout=60*60)
+    def get_servers_stats(self, servers):
+        '''
+        Obtiene las estadisticas de varios servidores en una sola consulta
+
+        @type servers: tuple
+        @param servers: ids de los servidores
+
+        @rtype dict
+        @return Estadisticas por id de servidor, sin los servidores que no tienen estadisticas
+        '''
+        data = {int(stats["_id"]):stats for stats in self.server_conn.foofind.search_stats.find({"_id":{"$in":[int(server) for server in servers]}})}
+        self.server_conn.end_request()
+        return data
+
     @cache.memoize(timeout=60*60)
     def get_servers(self):
         '''
@@ -1,13 +1,33 @@
 # -*- coding: utf-8 -*-
-import pymongo, sys
-from bson.code import Code
+import pymongo, sys, re
 from hashlib import sha256
 from datetime import datetime
 from time import time
+from math import exp
 
 from foofind.utils import hex2mid, check_collection_indexes, userid_parse, mid2hex, logging
 from foofind.services.extensions import cache
 
+def votes_summary(votes):
+    '''
+    Obtiene la valoración a partir de un documento de agregados de votos, aplicando
+    la funcion 1/1+E^(-X) para que el valor este entre 0 y 1.
+
+    @type votes: dict
+    @param votes: documento con la cuenta (cp, cn) y la suma (sp, sn) de votos positivos y negativos
+
+    @rtype dict
+    @return diccionario con la valoración (t), la cuenta (c) y la suma (s)
+    '''
+    c = [votes.get("cp", 0), votes.get("cn", 0)]
+    s = [votes.get("sp", 0), votes.get("sn", 0)]
+    total = c[0]+c[1]
+    if not total:
+        return {"t": 0.5, "c": c, "s": s}
+
+    # limita el exponente para que exp no se desborde con sumas muy grandes
+    val = max(-500, min(500, (s[0]*c[0]+s[1]*c[1])/float(total)))
+    return {"t": 1/(1+exp(-val)), "c": c, "s": s}
 
 class UsersStore(object):
     '''
@@ -34,7 +54,10 @@ class UsersStore(object):
             ),
         "comment_vote": (
             {"key": [("f", 1)]},
-            )
+            ),
+        "vote_sum": (
+            {"key": [("f", 1)]},
+            ),
         }
 
     def __init__(self):
@@ -201,57 +224,75 @@ class UsersStore(object):
             "d": datetime.utcnow(),
             "l": lang,
             }
+        file_hex = mid2hex(file_id)
         # TODO(felipe): borrar con error solucionado
         if user.id < 0 and user.is_authenticated():
             logging.error("Inconsistencia de usuario votando logeado id negativo.", extra=locals())
         else:
+            # se guarda el voto obteniendo el anterior, para descontarlo de los agregados
             if user.is_authenticated():
-                data["_id"] =  "%s_%s" % (mid2hex(file_id), user.id)
-                self.user_conn.users.vote.update(
+                data["_id"] =  "%s_%s" % (file_hex, user.id)
+                old_vote = self.user_conn.users.vote.find_and_modify(
                     {"_id": data["_id"]}, data, upsert=True)
             else:
-                data["_id"] = "%s:%s" % (mid2hex(file_id), user.session_ip)
-                self.user_conn.users.vote.update(
+                data["_id"] = "%s:%s" % (file_hex, user.session_ip)
+                old_vote = self.user_conn.users.vote.find_and_modify(
                     {"_id": data["_id"], "u": data["u"]},
                     data, upsert=True)
 
-        # Para cada idioma guarda el karma, la cuenta total y la suma
-        map_function = Code('''
-            function()
-            {
-                emit(this.l,{
-                    k:this.k,
-                    c:new Array((this.k>0)?1:0,(this.k<0)?1:0),
-                    s:new Array((this.k>0)?this.k:0,(this.k<0)?this.k:0)
-                })
-            }''')
-        # Suma todo y aplica la funcion 1/1+E^(-X) para que el valor este entre 0 y 1
-        reduce_function = Code('''
-            function(lang, vals)
-            {
-                c=new Array(0,0);
-                s=new Array(0,0);
-                for (var i in vals)
-                {
-                    c[0]+=vals[i].c[0];
-                    c[1]+=vals[i].c[1];
-                    s[0]+=vals[i].s[0];
-                    s[1]+=vals[i].s[1];
-                }
-                return {t:1/(1+Math.exp(-((s[0]*c[0]+s[1]*c[1])/(c[0]+c[1])))), c:c, s:s};
-            }''')
-        # Tercer parametro para devolverlo en vez de generar una coleccion nueva
-        votes = self.user_conn.users.vote.map_reduce(
-            map_function,
-            reduce_function,
-            {"inline": 1},
-            query = {"_id": {"$regex": "^%s" % mid2hex(file_id)}}
-            )
+            # Para cada idioma se guarda la cuenta y la suma de votos positivos y negativos
+            if self.user_conn.users.vote_sum.find_one({"f": file_hex}, {"_id": 1}) is None:
+                # primer voto o agregados sin calcular: se calculan con todos los votos del fichero, que ya incluyen este
+                self._save_files_votes_sums(self.user_conn.users.vote.find({"_id": {"$regex": "^%s" % file_hex}}, {"l":1, "k":1}))
+            else:
+                changes = {lang: [(data["k"], 1)]}
+                if old_vote:
+                    changes.setdefault(old_vote["l"], []).append((old_vote["k"], -1))
+                for sum_lang, sum_changes in changes.iteritems():
+                    self._inc_votes_sum(self.user_conn.users.vote_sum, "%s_%s" % (file_hex, sum_lang), sum_changes,
+                                        self.user_conn.users.vote, {"_id": {"$regex": "^%s" % file_hex}, "l": sum_lang},
+                                        {"f": file_hex, "l": sum_lang})
+
         # Devolver un diccionario de la forma idioma:valores
-        data = {values["_id"]: values["value"] for values in votes["results"]}
+        data = {values["l"]: votes_summary(values) for values in self.user_conn.users.vote_sum.find({"f": file_hex})}
         self.user_conn.end_request()
         return data
 
+    def _inc_votes_sum(self, collection, sum_id, changes, votes_collection, votes_query, fields=None):
+        '''
+        Suma o resta votos en un documento de agregados. Si el documento aún no existe se calcula
+        a partir de los votos guardados, que ya incluyen los cambios, para no guardar agregados parciales.
+
+        @type changes: list
+        @param changes: pares (valor del voto, 1 para sumarlo o -1 para restarlo)
+
+        @type votes_collection: Collection
+        @param votes_collection: colección de los votos
+
+        @type votes_query: dict
+        @param votes_query: consulta de los votos que forman el agregado
+
+        @type fields: dict
+        @param fields: campos a guardar si se crea el documento
+
+        @rtype dict
+        @return documento de agregados actualizado
+        '''
+        update = {}
+        for vote, amount in changes:
+            if vote: # los votos sin peso (karma 0) no se cuentan
+                key = "p" if vote>0 else "n"
+                update["c"+key] = update.get("c"+key, 0) + amount
+                update["s"+key] = update.get("s"+key, 0) + vote*amount
+
+        data = collection.find_and_modify({"_id":sum_id}, {"$inc":update}, new=True) if update else collection.find_one({"_id":sum_id})
+        if data is None:
+            values = self._sum_votes(votes_collection.find(votes_query, {"k":1}), lambda vote: sum_id).get(sum_id, {"cp":0, "cn":0, "sp":0, "sn":0})
+            if fields:
+                values.update(fields)
+            data = collection.find_and_modify({"_id":sum_id}, {"$set":values}, upsert=True, new=True)
+        return data
+
     @cache.memoize(timeout=60*60)
     def list_fav_lists(self, user):
         '''
@@ -411,7 +452,7 @@ class UsersStore(object):
 
     def set_file_comment(self, file_id, user, lang, comment):
         '''
-        Guarda un comentario de un archivo
+        Guarda un comentario de un archivo y lo suma a la cuenta de comentarios del archivo
         '''
         data = self.user_conn.users.comment.insert({
             "_id": "%s_%s" % (user.id, int(time())),
@@ -421,21 +462,39 @@ class UsersStore(object):
             "k": user.karma,
             "t": comment
             })
+        self._inc_comments_sum(file_id, lang, 1)
         self.user_conn.end_request()
         return data
 
+    def _inc_comments_sum(self, file_id, lang, amount):
+        '''
+        Actualiza la cuenta de comentarios por idioma de un archivo y borra su copia en caché.
+        Si el archivo aún no tiene cuenta se calcula con sus comentarios, que ya incluyen el cambio.
+        '''
+        result = self.user_conn.users.comment_sum.update({"_id": hex2mid(file_id)}, {"$inc": {"c.%s" % lang: amount}})
+        if not result or not result.get("updatedExisting"):
+            self.user_conn.users.comment_sum.update({"_id": hex2mid(file_id)}, {"$set": {"c": self._count_file_comments(file_id)}}, upsert=True)
+        self.get_file_comments_sum.flush(self, file_id)
+
+    def _count_file_comments(self, file_id):
+        '''
+        Cuenta los comentarios guardados de un archivo para cada idioma.
+        '''
+        sums = {}
+        for comment in self.user_conn.users.comment.find({"f": hex2mid(file_id)}, {"l":1}):
+            sums[comment["l"]] = sums.get(comment["l"], 0) + 1
+        return sums
+
+    @cache.memoize(timeout=60*60)
     def get_file_comments_sum(self, file_id):
         '''
-        Cuenta los comentarios que hay para cada idioma
+        Cuenta los comentarios que hay para cada idioma, contándolos si el archivo aún no tiene cuenta
         '''
-        data = {
-            lang["l"]: lang["c"]
-            for lang in self.user_conn.users.comment.group(
-                {"l": 1}, {'f': hex2mid(file_id)}, {"c": 0},
-                Code("function(o,p){p.c++}"))
-            }
+        data = self.user_conn.users.comment_sum.find_one({"_id": hex2mid(file_id)})
+        sums = data["c"] if data else self._count_file_comments(file_id)
         self.user_conn.end_request()
-        return data
+        return {lang: count for lang, count in sums.iteritems() if count>0}
+    get_file_comments_sum.make_cache_key = lambda self, file_id: "memoized/usersstore.get_file_comments_sum/%s" % mid2hex(file_id)
 
     def get_file_comments(self,file_id,lang):
         '''
@@ -450,44 +509,98 @@ class UsersStore(object):
         '''
         Guarda el comentario en la colección y actualiza el archivo correspondiente con los nuevos datos
         '''
-        self.user_conn.users.comment_vote.save({"_id":"%s_%s"%(str(comment_id), str(user.id)),"u":user.id,"f":file_id,"k":user.karma if vote==1 else -user.karma,"d":datetime.utcnow()})
-        #guarda el karma, la cuenta total, la suma y el usuario
-        map_function=Code('''
-            function()
-            {
-                var pos=this._id.lastIndexOf('_');
-                emit('1',{
-                        k:this.k,
-                        c:new Array((this.k>0)?1:0, (this.k<0)?1:0),
-                        s:new Array((this.k>0)?this.k:0,(this.k<0)?this.k:0)/*,
-                        u:(this.u=="%d")?this.k:0*/
-                })
-            }''' % user.id)
-        #suma todo y aplica la funcion 1/1+E^(-X) para que el valor este entre 0 y 1
-        reduce_function=Code('''
-            function(lang, vals)
-            {
-                var c=new Array(0,0);
-                var s=new Array(0,0);
-                var u=0;
-                for(var i in vals)
-                {
-                    c[0]+=vals[i].c[0];
-                    c[1]+=vals[i].c[1];
-                    s[0]+=vals[i].s[0];
-                    s[1]+=vals[i].s[1];
-                    //u+=vals[i].u;
-                }
-                return {t:1/(1+Math.exp(-((s[0]*c[0]+s[1]*c[1])/(c[0]+c[1])))), c:c, s:s/*, u:u*/};
-            }''')
-        #tercer parametro para devolverlo en vez de generar una coleccion nueva
-        votes=self.user_conn.users.comment_vote.map_reduce(map_function,reduce_function,{"inline":1},query={'_id':{'$regex':"^%s"%comment_id}})
+        vote_data = {"_id":"%s_%s"%(str(comment_id), str(user.id)),"u":user.id,"f":file_id,"k":user.karma if vote==1 else -user.karma,"d":datetime.utcnow()}
+        old_vote = self.user_conn.users.comment_vote.find_and_modify({"_id":vote_data["_id"]}, vote_data, upsert=True)
+
+        #guarda la cuenta y la suma de votos positivos y negativos del comentario
+        changes = [(vote_data["k"], 1)]
+        if old_vote:
+            changes.append((old_vote["k"], -1))
+        votes = self._inc_votes_sum(self.user_conn.users.comment_vote_sum, comment_id, changes,
+                                    self.user_conn.users.comment_vote, {"_id": {"$regex": "^%s_" % re.escape(str(comment_id))}})
+
         #crear diccionario de la forma idioma:valores, actualizar el comentario con el y devolverlo
-        data={values["_id"]:values["value"] for values in votes["results"]}
+        data={"1":votes_summary(votes)}
         self.user_conn.users.comment.update({"_id":comment_id},{"$set":{"vs":data}})
         self.user_conn.end_request()
         return data
 
+    def _sum_votes(self, votes, key):
+        '''
+        Calcula los agregados de una colección de votos. Los votos sin peso (karma 0) no se cuentan.
+
+        @type key: callable
+        @param key: función que obtiene el id del documento de agregados de un voto
+        '''
+        sums = {}
+        for vote in votes:
+            if not vote["k"]:
+                continue
+            sum_id = key(vote)
+            if sum_id not in sums:
+                sums[sum_id] = {"cp":0, "cn":0, "sp":0, "sn":0}
+            suffix = "p" if vote["k"]>0 else "n"
+            sums[sum_id]["c"+suffix] += 1
+            sums[sum_id]["s"+suffix] += vote["k"]
+        return sums
+
+    def _save_files_votes_sums(self, votes):
+        '''
+        Calcula y guarda los agregados por fichero e idioma de unos votos de ficheros.
+
+        @rtype int
+        @return número de agregados guardados
+        '''
+        sums = self._sum_votes(votes, lambda vote: (vote["_id"][:24], vote.get("l")))
+        for (file_hex, lang), values in sums.iteritems():
+            values.update(f=file_hex, l=lang)
+            self.user_conn.users.vote_sum.update({"_id":"%s_%s" % (file_hex, lang)}, {"$set":values}, upsert=True)
+        return len(sums)
+
+    def rebuild_votes_sums(self):
+        '''
+        Regenera los agregados de votos de ficheros y comentarios a partir de los votos guardados.
+        Los agregados que no existen se calculan al recibir el primer voto, pero los guardados
+        antes de llevar las cuentas así pueden ser parciales: hay que ejecutarlo una vez al desplegar.
+        Los votos que lleguen mientras se regeneran pueden quedar sin contar.
+
+        @rtype tuple
+        @return número de agregados de ficheros y de comentarios guardados
+        '''
+        users = self.user_conn.users
+
+        # ficheros: un documento por fichero e idioma
+        files_count = self._save_files_votes_sums(users.vote.find({}, {"l":1, "k":1}))
+
+        # comentarios: un documento por comentario, se actualiza también su resumen
+        votes = users.comment_vote.find({}, {"k":1})
+        sums = self._sum_votes(votes, lambda vote: vote["_id"].rsplit("_", 1)[0])
+        for comment_id, values in sums.iteritems():
+            users.comment_vote_sum.update({"_id":comment_id}, {"$set":values}, upsert=True)
+            users.comment.update({"_id":comment_id}, {"$set":{"vs":{"1":votes_summary(values)}}})
+        self.user_conn.end_request()
+        return files_count, len(sums)
+
+    def rebuild_comments_sums(self):
+        '''
+        Regenera las cuentas de comentarios por idioma de los archivos a partir de los comentarios guardados.
+        Las cuentas que no existen se calculan al leerlas o al recibir el primer comentario, pero las guardadas
+        antes de llevar las cuentas así pueden ser parciales: hay que ejecutarlo una vez al desplegar.
+        Las cuentas en caché se actualizan al caducar.
+
+        @rtype int
+        @return número de archivos con comentarios
+        '''
+        users = self.user_conn.users
+        sums = {}
+        for comment in users.comment.find({}, {"f":1, "l":1}):
+            file_sums = sums.setdefault(hex2mid(comment["f"]), {})
+            file_sums[comment["l"]] = file_sums.get(comment["l"], 0) + 1
+        for file_id, file_sums in sums.iteritems():
+            users.comment_sum.update({"_id": file_id}, {"$set": {"c": file_sums}}, upsert=True)
+        self.user_conn.end_request()
+        return len(sums)
+
     def count_users(self):
         return self.user_conn.users.users.find({"active":1}).count()
 
@@ -499,3 +612,11 @@ class UsersStore(object):
         for document in cursor:
             yield cursor
         self.user_conn.end_request()
+
+if __name__=="__main__":
+    # regeneración de los agregados de votos y comentarios: python -m foofind.services.db.usersstore [mongodb://host:port]
+    from foofind import defaults
+    usersdb = UsersStore()
+    usersdb.share_connections(pymongo.MongoClient(sys.argv[1] if len(sys.argv)>1 else defaults.DATA_SOURCE_USER))
+    print "files votes sums: %d, comments votes sums: %d" % usersdb.rebuild_votes_sums()
+    print "files comments sums: %d" % usersdb.rebuild_comments_sums()
@@ -3,10 +3,15 @@
 from collections import defaultdict
 from math import sqrt, log
 
-from foofind.utils import mid2hex, hex2bin, logging
+from foofind.utils import mid2hex, hex2bin, logging, LRUCache
 from foofind.utils.event import EventManager
 from .results_browser import get_src
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class SearchProxy:
     def __init__(self, config, filesdb, entitiesdb, profiler, sphinx):
         self.config = config
@@ -18,6 +23,20 @@ class SearchProxy:
         # logs de informacion
         self.bot_events = defaultdict(int)
 
+        # planes de consultas compiladas
+        self.query_plans = LRUCache(config["SEARCH_QUERY_PLANS_CACHE_SIZE"])
+
+        # estadisticas combinadas para todos los servidores, se actualizan en update_servers
+        self.servers_stats = {}
+        self.stats = {"sg":defaultdict(int), # subgrupos
+                      "rc":defaultdict(int), "ra":defaultdict(int), "rv":defaultdict(int), "rd":{}, "rM":defaultdict(int), # por rating
+                      "src":defaultdict(int), "src_rc":defaultdict(int), "src_ra":defaultdict(int), "src_rv":defaultdict(int), "src_rd":defaultdict(int) # por rating y origen
+                      }
+        self.subgroups_stats_sums = {} # sumas acumuladas por subgrupo
+        self.sources_stats_sums = {}   # sumas acumuladas por origen
+        self.stats_refreshes = 0       # actualizaciones con cambios, para recalcular las sumas por origen periodicamente
+        self.sources_rating_count = self.sources_rating_average = self.sources_rating_variance = self.sources_rating_standard_deviation = {}
+
         # actualiza información de servidores
         self.update_servers()
 
@@ -30,43 +49,123 @@ class SearchProxy:
         # informacion de accesos de bots
         profiling_info, self.bot_events = self.bot_events, defaultdict(int)
 
+        # informacion de uso del cache de planes de consultas
+        query_plans_stats = self.query_plans.stats(reset=True)
+        profiling_info["qp_hits"] = query_plans_stats["hits"]
+        profiling_info["qp_misses"] = query_plans_stats["misses"]
+        profiling_info["qp_evictions"] = query_plans_stats["evictions"]
+        profiling_info["qp_size"] = query_plans_stats["size"]
+
         # guarda información
         self.profiler.save_data(profiling_info)
 
     def update_sources(self):
+        # aplica la información de origenes de una vez para no mostrar estados intermedios a las busquedas
+        self.__dict__.update(self._load_sources(self.stats, self.sources_rating_standard_deviation, self.sources_rating_average))
+        self.sphinx.update_blocked_sources(self.blocked_sources)
+
+    def _load_sources(self, stats, sources_rating_standard_deviation, sources_rating_average):
+        '''
+        Obtiene los origenes y calcula la información derivada a partir de las estadisticas dadas.
+        Devuelve los nuevos valores de los atributos, sin modificar los actuales.
+        '''
         # obtiene los origenes
-        self.sources = {int(s["_id"]): s for s in self.filesdb.get_sources(blocked=None)}
+        all_sources = {int(s["_id"]): s for s in self.filesdb.get_sources(blocked=None)}
 
         # actualiza origenes bloqueados
-        self.blocked_sources = [sid for sid, s in self.sources.iteritems() if "crbl" in s and int(s["crbl"])!=0]
-        self.sphinx.update_blocked_sources(self.blocked_sources)
+        blocked_sources = [sid for sid, s in all_sources.iteritems() if "crbl" in s and int(s["crbl"])!=0]
 
         # calcula pesos para origenes individuales por calidad
-        self.sources_weights = _update_source_weights(self.sources, self.blocked_sources)
+        sources_weights = _update_source_weights(all_sources, blocked_sources)
 
         # listado de origenes ordenados por cantidad de ficheros
-        sources = self.stats["src"]
-        sources_relevance = sorted(((sources[sid], sid, s["g"]) for sid, s in self.sources.iteritems() if sid not in self.blocked_sources), reverse=True)
-        self.sources_relevance_streaming = [self.sources[sid]["d"]
-                                                for (count,sid,group) in sources_relevance if "s" in group]
-        self.sources_relevance_download = [self.sources[sid]["d"]
-                                                for (count,sid,group) in sources_relevance if ("w" in group or "f" in group)]
-        self.sources_relevance_p2p = ["Torrent","eD2k","Gnutella"]
+        sources = stats["src"]
+        sources_relevance = sorted(((sources.get(sid, 0), sid, s["g"]) for sid, s in all_sources.iteritems() if sid not in blocked_sources), reverse=True)
+        sources_relevance_streaming = [all_sources[sid]["d"] for (count,sid,group) in sources_relevance if "s" in group]
+        sources_relevance_download = [all_sources[sid]["d"] for (count,sid,group) in sources_relevance if ("w" in group or "f" in group)]
+
+        return {"sources": all_sources,
+                "blocked_sources": blocked_sources,
+                "sources_weights": sources_weights,
+                # empaqueta las estadisticas por origen para normalizar pesos en bloque
+                "sources_rating_arrays": _pack_sources_stats(sources_rating_standard_deviation, sources_rating_average, sources_weights),
+                "sources_relevance_streaming": sources_relevance_streaming,
+                "sources_relevance_download": sources_relevance_download,
+                "sources_relevance_p2p": ["Torrent","eD2k","Gnutella"],
+                # indice de origenes por valor del filtro, con su cache de combinaciones de valores
+                "sources_filter": (_build_sources_filter_index(all_sources, sources_relevance_streaming[:8], sources_relevance_download[:8]),
+                                    LRUCache(self.config["SEARCH_SOURCES_FILTERS_CACHE_SIZE"]))}
+
+    def get_sources_filter(self, src):
+        '''
+        Obtiene los ids de los origenes que corresponden a los valores del filtro por origen.
+
+        @type src: list o str
+        @param src: dominios sin extension, nombres de grupos de origenes, "other-streamings" u "other-downloads"
+        '''
+        index, cache = self.sources_filter
+        # los filtros antiguos de una letra llegan como una cadena con el nombre del grupo
+        key = frozenset((src,) if isinstance(src, basestring) else src)
+        sources = cache.get(key)
+        if sources is None:
+            sources = set()
+            for value in key:
+                if value in index:
+                    sources |= index[value]
+            sources = sorted(sources)
+            cache.set(key, sources)
+        return list(sources)
 
     def update_servers(self):
         # obtiene los servidores activos para busquedas
-        self.servers = {str(int(server["_id"])):(str(server["sp"]), int(server["spp"])) for server in self.filesdb.get_servers() if "sp" in server and server["sp"]}
+        servers = {str(int(server["_id"])):(str(server["sp"]), int(server["spp"])) for server in self.filesdb.get_servers() if "sp" in server and server["sp"]}
+
+        # estadisticas de busqueda de todos los servidores en una sola consulta
+        try:
+            loaded_stats = self.filesdb.get_servers_stats(tuple(sorted(int(server_id) for server_id in servers.iterkeys())))
+        except Exception:
+            logging.exception("Error loading servers stats, keeping previous ones.")
+            loaded_stats = {}
+
+        # los servidores sin estadisticas mantienen las ultimas conocidas, solo se reagregan los servidores que han cambiado
+        new_servers_stats = {server_id:loaded_stats.get(int(server_id)) or self.servers_stats.get(server_id) for server_id in servers.iterkeys()}
+        changed_servers = [server for server in set(new_servers_stats).union(self.servers_stats)
+                                if new_servers_stats.get(server)!=self.servers_stats.get(server)]
+
+        snapshot = {"servers": servers, "servers_set": set(servers.iterkeys()), "servers_stats": new_servers_stats}
+        if changed_servers:
+            # las sumas por origen se recalculan desde los subgrupos periodicamente, para que no acumulen errores de redondeo
+            full = not self.stats_refreshes % self.config["SERVERS_STATS_FULL_REFRESH"]
+            snapshot["stats_refreshes"] = self.stats_refreshes+1
+            snapshot.update(self._update_stats(new_servers_stats, changed_servers, full))
+            stats = snapshot["stats"]
+            snapshot["sources_rating_count"] = stats["src_rc"]
+            snapshot["sources_rating_average"] = stats["src_ra"]
+            snapshot["sources_rating_variance"] = stats["src_rv"]
+            snapshot["sources_rating_standard_deviation"] = stats["src_rd"]
+        else:
+            stats = self.stats
 
-        self.servers_set = set(self.servers.iterkeys())
+        # pesos para los origenes por tipo
+        snapshot.update(self._load_sources(stats, snapshot.get("sources_rating_standard_deviation", self.sources_rating_standard_deviation),
+                                            snapshot.get("sources_rating_average", self.sources_rating_average)))
 
-        # estadisticas de busqueda por servidor
-        new_servers_stats = {server_id:self.filesdb.get_server_stats(int(server_id)) for server_id in self.servers.iterkeys()}
+        # sustituye todos los valores de una vez, las busquedas ven el estado anterior o el nuevo completo
+        self.__dict__.update(snapshot)
+        self.sphinx.update_blocked_sources(self.blocked_sources)
 
-        # estadisticas combinadas para todos los servidores
-        new_stats = {"sg":defaultdict(int), # subgrupos
-                      "rc":defaultdict(int), "ra":defaultdict(int), "rv":defaultdict(int), "rd":{}, "rM":defaultdict(int), # por rating
-                      "src":defaultdict(int), "src_rc":defaultdict(int), "src_ra":defaultdict(int), "src_rv":defaultdict(int), "src_rd":defaultdict(int) # por rating y origen
-                      }
+    def _update_stats(self, servers_stats, changed_servers, full=False):
+        '''
+        Actualiza las estadisticas combinadas para todos los servidores.
+        Solo se recalculan los subgrupos de los servidores que han cambiado y los origenes de estos subgrupos,
+        manteniendo sumas acumuladas por subgrupo y por origen. Si full es True, las sumas de todos los
+        origenes se recalculan a partir de las de los subgrupos.
+        Devuelve los nuevos valores de los atributos, sin modificar los actuales.
+        '''
+        # copias de las estadisticas actuales que se modificaran
+        new_stats = {key:value.copy() for key, value in self.stats.iteritems()}
+        subgroups_sums = self.subgroups_stats_sums.copy()
+        sources_sums = self.sources_stats_sums.copy()
 
         # evita multiples accesos a mismas claves globales
         subgroups = new_stats["sg"]
@@ -75,70 +174,145 @@ class SearchProxy:
         rating_variance = new_stats["rv"]
         rating_maximum = new_stats["rM"]
         rating_deviation = new_stats["rd"]
-
-        # recorre la información de cada servidor
-        for server, server_stats in new_servers_stats.iteritems():
-
-            # evita multiples accesos a mismas claves para el servidor
-            server_rating_count = server_stats["rc"]
-            server_rating_average = server_stats["ra"]
-            server_rating_pow_average = server_stats["rpa"]
-            server_rating_maximum = server_stats["rM"]
-
-            # recorre los subgrupos del servidor
-            for sg, count in server_stats["sg"].iteritems():
-                subgroups[sg] += count
-                if sg in server_rating_count:
-                    rating_count[sg] += server_rating_count[sg]                                 # numero de entradas con rating
-                    rating_average[sg] += server_rating_average[sg] * server_rating_count[sg]   # valor medio del rating (a falta de normalizar)
-                    rating_variance[sg] += server_rating_pow_average[sg]                        # varianza del rating (a falta de normalizar)
-                    rating_maximum[sg] = max(rating_maximum[sg], server_rating_maximum)         # maximo rating
-
-        # actualiza valores dependientes de valores totales que no se pueden calcular en el bucle anterior
-        for sg, count in rating_count.iteritems():
-            rating_average[sg] /= count
-            rating_variance[sg] /= count
-            rating_deviation[sg] = sqrt(rating_variance[sg])
-
-        # estadisticas por origenes
         sources = new_stats["src"]
-        new_sources_rating_count = new_stats["src_rc"]
-        new_sources_rating_average = new_stats["src_ra"]
-        new_sources_rating_variance = new_stats["src_rv"]
-        new_sources_rating_standard_deviation = new_stats["src_rd"]
+        sources_rating_count = new_stats["src_rc"]
+        sources_rating_average = new_stats["src_ra"]
+        sources_rating_variance = new_stats["src_rv"]
+        sources_rating_standard_deviation = new_stats["src_rd"]
+
+        # subgrupos afectados por los cambios, tanto los que estaban como los que estan ahora
+        changed_subgroups = set()
+        for server in changed_servers:
+            for server_stats in (self.servers_stats.get(server), servers_stats.get(server)):
+                if server_stats:
+                    changed_subgroups.update(server_stats["sg"])
+
+        all_servers_stats = [server_stats for server_stats in servers_stats.itervalues() if server_stats]
+        changed_sources = set()
+        for sg in changed_subgroups:
+            # recalcula el subgrupo a partir de la información de cada servidor
+            count = sg_rating_count = sg_rating_sum = sg_rating_pow_sum = maximum = 0
+            present = rated = False
+            for server_stats in all_servers_stats:
+                server_count = server_stats["sg"].get(sg)
+                if server_count is None:
+                    continue
+                present = True
+                count += server_count
+                server_rating_count = server_stats["rc"]
+                if sg in server_rating_count:
+                    rated = True
+                    sg_rating_count += server_rating_count[sg]                           # numero de entradas con rating
+                    sg_rating_sum += server_stats["ra"][sg] * server_rating_count[sg]     # suma de los ratings
+                    sg_rating_pow_sum += server_stats["rpa"][sg]                          # suma de los cuadrados de los ratings
+                    maximum = max(maximum, server_stats["rM"])                            # maximo rating
 
-        # recorre subgrupos agrupando por origenes
-        for sg, count in subgroups.iteritems():
+            # actualiza las sumas del origen con la diferencia respecto a los valores anteriores del subgrupo
             src = get_src(sg)
-            sources[src] += count
-            if sg in rating_count:
-                new_sources_rating_count[src] += rating_count[sg]
-                new_sources_rating_average[src] += rating_average[sg]*rating_count[sg]
-                new_sources_rating_variance[src] += rating_variance[sg]*rating_count[sg]
-
-        # actualiza valores dependientes de valores totales que no se pueden calcular en el bucle anterior
-        for src, count in new_sources_rating_count.iteritems():
-            new_sources_rating_average[src] /= count
-            new_sources_rating_variance[src] /= count
-            new_sources_rating_standard_deviation[src] = sqrt(new_sources_rating_variance[src])
-
-        self.servers_stats = new_servers_stats
-        self.stats = new_stats
-        self.sources_rating_count = new_sources_rating_count
-        self.sources_rating_average = new_sources_rating_average
-        self.sources_rating_variance = new_sources_rating_variance
-        self.sources_rating_standard_deviation = new_sources_rating_standard_deviation
-        self.sources_rating_count = new_sources_rating_count
-        self.sources_rating_average = new_sources_rating_average
-        self.sources_rating_variance = new_sources_rating_variance
-        self.sources_rating_standard_deviation = new_sources_rating_standard_deviation
-
-        # pesos para los origenes por tipo
-        self.update_sources()
+            changed_sources.add(src)
+            old_present, old_count, old_rated, old_rating_count, old_rating_sum, old_rating_pow_sum = subgroups_sums.get(sg, (False, 0, False, 0, 0, 0))
+            src_subgroups, src_count, src_rated, src_rating_count, src_rating_sum, src_rating_pow_sum = sources_sums.get(src, (0, 0, 0, 0, 0, 0))
+            sources_sums[src] = (src_subgroups+present-old_present, src_count+count-old_count, src_rated+rated-old_rated,
+                                    src_rating_count+sg_rating_count-old_rating_count, src_rating_sum+sg_rating_sum-old_rating_sum,
+                                    src_rating_pow_sum+sg_rating_pow_sum-old_rating_pow_sum)
+
+            # actualiza los valores del subgrupo
+            if present:
+                subgroups_sums[sg] = (present, count, rated, sg_rating_count, sg_rating_sum, sg_rating_pow_sum)
+                subgroups[sg] = count
+            else:
+                del subgroups_sums[sg]
+                subgroups.pop(sg, None)
+
+            if rated and sg_rating_count:
+                rating_count[sg] = sg_rating_count
+                rating_average[sg] = sg_rating_sum/sg_rating_count
+                rating_variance[sg] = max(0., sg_rating_pow_sum/sg_rating_count)
+                rating_deviation[sg] = sqrt(rating_variance[sg])
+                rating_maximum[sg] = maximum
+            else:
+                for values in (rating_count, rating_average, rating_variance, rating_deviation, rating_maximum):
+                    values.pop(sg, None)
+
+        # recalcula las sumas de todos los origenes a partir de las de sus subgrupos
+        if full:
+            changed_sources.update(sources_sums)
+            sources_sums = {}
+            for sg, (present, count, rated, sg_rating_count, sg_rating_sum, sg_rating_pow_sum) in subgroups_sums.iteritems():
+                src = get_src(sg)
+                changed_sources.add(src)
+                src_subgroups, src_count, src_rated, src_rating_count, src_rating_sum, src_rating_pow_sum = sources_sums.get(src, (0, 0, 0, 0, 0, 0))
+                sources_sums[src] = (src_subgroups+present, src_count+count, src_rated+rated,
+                                        src_rating_count+sg_rating_count, src_rating_sum+sg_rating_sum, src_rating_pow_sum+sg_rating_pow_sum)
+
+        # actualiza los valores de los origenes afectados
+        for src in changed_sources:
+            src_subgroups, src_count, src_rated, src_rating_count, src_rating_sum, src_rating_pow_sum = sources_sums.get(src, (0, 0, 0, 0, 0, 0))
+            if src_subgroups:
+                sources[src] = src_count
+            else:
+                sources_sums.pop(src, None)
+                sources.pop(src, None)
+
+            if src_rated and src_rating_count:
+                sources_rating_count[src] = src_rating_count
+                sources_rating_average[src] = src_rating_sum/src_rating_count
+                # las sumas acumuladas pueden quedar ligeramente negativas por errores de redondeo
+                sources_rating_variance[src] = max(0., src_rating_pow_sum/src_rating_count)
+                sources_rating_standard_deviation[src] = sqrt(sources_rating_variance[src])
+            else:
+                for values in (sources_rating_count, sources_rating_average, sources_rating_variance, sources_rating_standard_deviation):
+                    values.pop(src, None)
+
+        return {"stats": new_stats, "subgroups_stats_sums": subgroups_sums, "sources_stats_sums": sources_sums}
 
     def log_bot_event(self, bot, result):
         self.bot_events[("bot_" if result else "bot_no_") + bot] += 1
 
+# nombres de los grupos de origenes en el filtro por origen
+SOURCES_FILTER_GROUPS = {"s":"streaming","w":"download","f":"download","p":"p2p","g":"gnutella","t":"torrent","e":"ed2k"}
+
+def _build_sources_filter_index(sources, top_streaming, top_download):
+    '''
+    Construye el indice de ids de origenes por cada valor posible del filtro por origen:
+    dominio sin extension, nombre de grupo, y origenes fuera de los listados principales de streaming o descarga.
+    '''
+    index = defaultdict(set)
+    top_streaming = set(top_streaming)
+    top_download = set(top_download)
+    for source_id, source in sources.iteritems():
+        domain = source["d"]
+        groups = source["g"]
+        index[domain[:domain.rfind(".")]].add(source_id)
+        for group in groups:
+            if group in SOURCES_FILTER_GROUPS:
+                index[SOURCES_FILTER_GROUPS[group]].add(source_id)
+        if "s" in groups and domain not in top_streaming:
+            index["other-streamings"].add(source_id)
+        if ("w" in groups or "f" in groups) and domain not in top_download:
+            index["other-downloads"].add(source_id)
+    return {value:frozenset(ids) for value, ids in index.iteritems()}
+
+def _pack_sources_stats(standard_deviations, averages, weights):
+    '''
+    Empaqueta las estadisticas por origen en arrays indexados por id de origen.
+    La ultima posición se reserva para los origenes desconocidos, con valores a 0.
+    '''
+    if numpy is None:
+        return None
+
+    size = max(max(stats) if stats else 0 for stats in (standard_deviations, averages, weights))+2
+    packed_deviations = numpy.zeros(size)
+    packed_averages = numpy.zeros(size)
+    packed_weights = numpy.zeros(size)
+    for sid, value in standard_deviations.iteritems():
+        packed_deviations[sid] = round(value, 3)
+    for sid, value in averages.iteritems():
+        packed_averages[sid] = value
+    for sid, value in weights.iteritems():
+        packed_weights[sid] = value
+    return packed_deviations, packed_averages, packed_weights
+
 def _update_source_weights(sources, blocked_sources):
     results = {}
 
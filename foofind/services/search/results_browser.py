@@ -1,6 +1,16 @@
 # -*- coding: utf-8 -*-
 from sphinxservice import *
 from math import exp
+from heapq import heapify, heappush, heappop
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# numero minimo de subgrupos para normalizar pesos en bloque con numpy
+NORMALIZE_BATCH_MIN_SIZE = 64
 
 def get_ct(sg):
     return (int(sg)&0xF0000000L)>>28
@@ -31,7 +41,10 @@ class ResultsBrowser:
         self.tree_visitor = tree_visitor or DEFAULT_TREE_VISITOR
         self.sure = True
         self.subgroups = {}
-        self.visits = {}
+        self.visits = {}            # posicion actual y resultados de cada subgrupo, por subgrupo y servidor
+        self.heaps = {}             # colas de prioridad de los hijos de cada rama del arbol, por ruta
+        self.subgroup_servers = {}  # servidores que tienen cada subgrupo
+        self.head_weights = {}      # peso del siguiente resultado de cada subgrupo, por servidor
         self.requests = {}
         self.versions = {}
         self._create_tree()
@@ -54,14 +67,21 @@ class ResultsBrowser:
             if self.sure and part_info[1]:
                 self.sure = False
 
-            self.subgroups[key[1]] = subgroups = part_info[-1]
+            server = key[1]
+            self.subgroups[server] = subgroups = part_info[-1]
+            self.head_weights[server] = head_weights = self._normalize_weights(subgroups)
 
             # recorre subgrupos del servidor
             for isg, (count, result) in subgroups.iteritems():
                 total += count
-                ict, isrc = get_ct(isg), get_src(isg)
-                sg, ct, src = str(isg), str(ict), str(isrc)
-                nweight = self._normalize_weight(result[-2], result[-1], ict, isrc)
+                sg, ct, src = str(isg), str(get_ct(isg)), str(get_src(isg))
+                nweight = head_weights[isg]
+
+                # indice de servidores por subgrupo
+                if isg in self.subgroup_servers:
+                    self.subgroup_servers[isg].append(server)
+                else:
+                    self.subgroup_servers[isg] = [server]
 
                 # crea u obtiene rama por tipo de contenido
                 if ct in tree:
@@ -90,6 +110,46 @@ class ResultsBrowser:
                             group["_w"] = nweight
         self.total = total
 
+        # crea las colas de prioridad de cada rama
+        self._create_heap(tree, ())
+        for ct, group in tree.iteritems():
+            self._create_heap(group, (ct,))
+            for src, group2 in group.iteritems():
+                if src[0]!="_":
+                    self._create_heap(group2, (ct, src))
+
+    def _create_heap(self, branch, path):
+        tree_visitor = self.tree_visitor
+        self.heaps[path] = heap = []
+        for key, child in branch.iteritems():
+            if key[0]=="_": continue
+            weight = tree_visitor((key, child))
+            if weight is not None:
+                heap.append((-weight, key))
+        heapify(heap)
+
+    def _update_heap(self, branch, path, key):
+        '''
+        Añade a la cola de prioridad el nuevo peso del hijo de una rama.
+        Las entradas con pesos antiguos se descartan al llegar a la cabeza de la cola.
+        '''
+        weight = self.tree_visitor((key, branch[key]))
+        if weight is not None:
+            heappush(self.heaps[path], (-weight, key))
+
+    def _best_child(self, branch, path):
+        '''
+        Obtiene el hijo con más peso de una rama y su peso, o None si no tiene hijos.
+        '''
+        heap = self.heaps[path]
+        tree_visitor = self.tree_visitor
+        while heap:
+            weight, key = heap[0]
+            if key in branch and tree_visitor((key, branch[key]))==-weight:
+                return key, -weight
+            heappop(heap) # la entrada ya no es valida
+        return None, None
+
     def __iter__(self):
         return self
 
@@ -105,52 +165,87 @@ class ResultsBrowser:
         normalized_rating = self.context.proxy.sources_weights.get(isrc,0)*(1./(1+exp(-val)) if std_dev else rating)
         return self.weight_processor(weight, self.ct_weights[ict], rating, normalized_rating)
 
+    def _normalize_weights(self, subgroups):
+        '''
+        Normaliza los pesos de los primeros resultados de los subgrupos de un servidor.
+        Con suficientes subgrupos y numpy disponible, calcula todos los pesos en bloque.
+        '''
+        packed_stats = getattr(self.context.proxy, "sources_rating_arrays", None)
+        if packed_stats is None or len(subgroups)<NORMALIZE_BATCH_MIN_SIZE:
+            return {isg: self._normalize_weight(result[-2], result[-1], get_ct(isg), get_src(isg)) for isg, (count, result) in subgroups.iteritems()}
+
+        deviations, averages, sources_weights = packed_stats
+        isgs = subgroups.keys()
+        heads = [result for count, result in subgroups.itervalues()]
+        ratings = numpy.array([result[-2] for result in heads], dtype=float)
+        weights = numpy.array([result[-1] for result in heads], dtype=float)
+
+        # tipos de contenido y origenes, los origenes desconocidos van a la ultima posicion
+        sgs = numpy.array(isgs, dtype=numpy.uint64)
+        cts = ((sgs&numpy.uint64(0xF0000000))>>numpy.uint64(28)).astype(numpy.intp)
+        srcs = numpy.minimum(((sgs&numpy.uint64(0xFFFF000))>>numpy.uint64(12)).astype(numpy.intp), len(deviations)-1)
+
+        # misma normalizacion que _normalize_weight
+        std_devs = numpy.where(ratings>=0, deviations[srcs], 0)
+        valid = std_devs>0
+        vals = numpy.clip((ratings-averages[srcs]*1.5)/numpy.where(valid, std_devs, 1), -500, 500)
+        ratings = numpy.where(valid, ratings, numpy.where(ratings==-1, 0.5, numpy.where(ratings==-2, 1.1, ratings)))
+        normalized_ratings = sources_weights[srcs]*numpy.where(valid, 1./(1+numpy.exp(-vals)), ratings)
+
+        ct_weights = numpy.zeros(16)
+        for ict in numpy.unique(cts).tolist():
+            ct_weights[ict] = self.ct_weights[ict]
+        ct_weights = ct_weights[cts]
+
+        if self.weight_processor is DEFAULT_WEIGHT_PROCESSOR:
+            nweights = (weights*ct_weights*normalized_ratings).tolist()
+        else:
+            nweights = map(self.weight_processor, weights.tolist(), ct_weights.tolist(), ratings.tolist(), normalized_ratings.tolist())
+        return dict(izip(isgs, nweights))
+
     def next(self):
         # no quedan resultados por devolver
         if not self.tree:
             raise StopIteration
 
-        tree_visitor = self.tree_visitor
-
         # busca el subgrupo en el que buscar
-        ct, group = max(self.tree.iteritems(), key=tree_visitor)
-        src, group2 = max(group.iteritems(), key=tree_visitor)
-        sg, subgroup = max(group2.iteritems(), key=tree_visitor)
+        ct = self._best_child(self.tree, ())[0]
+        group = self.tree[ct]
+        src = self._best_child(group, (ct,))[0]
+        group2 = group[src]
+        sg = self._best_child(group2, (ct, src))[0]
+        subgroup = group2[sg]
         isg = int(sg)
         ict = int(ct)
         isrc = int(src)
 
         # busca el servidor con mas peso
-        max_weight = None
-        for server, subgroups in self.subgroups.iteritems():
-            # ignora el servidor si no tiene el subgrupo
-            if isg not in subgroups: continue
-
-            # obtiene el numero de resultados y el primer resultado
-            count, result = subgroups[isg]
-
-            # obtiene la posicion en el grupo
-            if sg+server in self.visits:
-                position, results = self.visits[sg+server]
-                this_result = results[position] # el primer elemento es el numero de elementos disponibles y reemplaza al que está en el resumen
-                nweight = self._normalize_weight(this_result[-2], this_result[-1], ict, isrc)
-            else:
-                position = 0
-                this_result = result
-                nweight = self._normalize_weight(this_result[-2], this_result[-1], ict, isrc)
+        max_weight = next_weight = None
+        head_weights = self.head_weights
+        servers = self.subgroup_servers[isg]
+        for server in servers:
+            nweight = head_weights[server][isg]
 
             # mira si es el maximo
             if nweight>max_weight:
                 next_weight = max_weight
                 max_weight = nweight
                 max_server = server
-                max_position = position
-                max_result = this_result
-                max_count = count
             # si no, mira si es el siguiente
             elif nweight>next_weight:
                 next_weight = nweight
 
+        # obtiene el numero de resultados y el resultado actual en el servidor
+        max_count, summary_result = self.subgroups[max_server][isg]
+        visit_key = (isg, max_server)
+        visit = self.visits.get(visit_key)
+        if visit:
+            max_position, results = visit
+            max_result = results[max_position] # el primer elemento es el numero de elementos disponibles y reemplaza al que está en el resumen
+        else:
+            max_position = 0
+            max_result = summary_result
+
         # hay mas resultados disponibles en este subgrupo y servidor? hace falta pedirlos?
         delete_sg_server = need_request = False
         next_position = max_position+1
@@ -159,16 +254,17 @@ class ResultsBrowser:
         if next_position==max_count:
             delete_sg_server = True
         elif max_position: # no es el primer resultado, ya hay info de visita
-            if next_position>=self.visits[sg+max_server][1][0]:
+            if next_position>=visit[1][0]:
                 need_request = True
             else:
-                self.visits[sg+max_server][0] = next_position
+                visit[0] = next_position
         else:
-            if PART_SG_KEY+max_server+sg in self.results:
-                self.visits[sg+max_server] = [next_position, parse_data(self.results[PART_SG_KEY+max_server+sg])]
+            sg_key = PART_SG_KEY+max_server+sg
+            if sg_key in self.results:
+                self.visits[visit_key] = visit = [next_position, parse_data(self.results[sg_key])]
 
                 # si no hay resultados, debe pedir mas
-                if next_position>=self.visits[sg+max_server][1][0]:
+                if next_position>=visit[1][0]:
                     need_request = True
             else:
                 need_request = True
@@ -184,38 +280,46 @@ class ResultsBrowser:
                 self.fetch_more = False
         elif not delete_sg_server:
             # compara el siguiente peso en otros servidores con el siguiente peso del servidor
-            next_result = self.visits[sg+max_server][1][next_position]
-            server_next_weight = self._normalize_weight(next_result[-2], next_result[-1], ict, isrc)
+            next_result = visit[1][next_position]
+            server_next_weight = head_weights[max_server][isg] = self._normalize_weight(next_result[-2], next_result[-1], ict, isrc)
             if server_next_weight>next_weight:
                 next_weight = server_next_weight
 
         # elimina el subgrupo para el servidor si ya no tiene mas resultados
         if delete_sg_server or need_request:
-            if sg+max_server in self.visits: # si sólo hay un fichero en el subgrupo, esto no se ha creado
-                del self.visits[sg+max_server]
+            if visit_key in self.visits: # si sólo hay un fichero en el subgrupo, esto no se ha creado
+                del self.visits[visit_key]
             del self.subgroups[max_server][isg]
+            del head_weights[max_server][isg]
+            servers.remove(max_server)
 
         # actualiza peso del subgrupo
         if next_weight==None: # no hay mas resultados para este subgrupo
             del group2[sg]
+            del self.subgroup_servers[isg]
         else:
             subgroup["_u"]+=1
             subgroup["_w"]=next_weight
+            self._update_heap(group2, (ct, src), sg)
 
         # actualiza el subgrupo con mas peso en el grupo por origen
-        new_weight=tree_visitor(max(group2.iteritems(), key=tree_visitor))
+        new_weight = self._best_child(group2, (ct, src))[1]
         if new_weight==None: # no hay mas resultados para este grupo
             del group[src]
+            del self.heaps[ct, src]
         else:
             group2["_u"]+=1
             group2["_w"]=new_weight
+            self._update_heap(group, (ct,), src)
 
         # actualiza el subgrupo con mas peso en el grupo por tipo de contenido
-        new_weight=tree_visitor(max(group.iteritems(), key=tree_visitor))
+        new_weight = self._best_child(group, (ct,))[1]
         if new_weight==None: # no hay mas resultados para este grupo
             del self.tree[ct]
+            del self.heaps[ct,]
         else:
             group["_u"]+=1
             group["_w"]=new_weight
+            self._update_heap(self.tree, (), ct)
 
         return (str(ord(max_server)), sg, max_weight, max_result)
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 from sphinxservice import *
-from collections import defaultdict
-from itertools import groupby
+from collections import defaultdict, namedtuple
+from itertools import groupby, chain, imap
+from operator import ne
 import re, sys
 
 from foofind.utils.splitter import split_file, SEPPER
@@ -13,15 +14,65 @@ FIELD_NAMES = {"T": "@(fn,md) ", "F":"@fil ", "N": "@ntt "}
 
 SEASON_EPISODE_SEARCHER = re.compile(r"^(?P<s>\d{1,2})x(?P<e>\d{1,2})$")
 SEASON_EPISODE_SEARCHER2 = re.compile(r"^s(?P<s>\d{1,2})(\W*e(?P<e>\d{1,2}))?$")
-BLEND_CHARS = frozenset(r"+&-@!$%?#")
+BLEND_CHARS_STRING = r"+&-@!$%?#"
+BLEND_CHARS = frozenset(BLEND_CHARS_STRING)
+NOT_CHARS_STRING = "-!"
 NGRAM_CHARS = frozenset(unichr(i) for i in xrange(0x3000, 0x2FA1F)) if sys.maxunicode>2**16 else frozenset()
 
 NON_TEXT_CHARS = frozenset(SEPPER.union(set(u"'½²º³ª\u07e6\u12a2\u1233\u179c\u179fµ")).difference(BLEND_CHARS))
+QUERY_SPECIAL_CHARS = frozenset(u"()\"")
 WORD_SEARCH_MIN_LEN = 2
 BLOCKED_WORDS = frozenset(["www"])
 
 START_SEEN_WORDS = {word:-1 for word in BLOCKED_WORDS}
 
+def _char_class(chars):
+    '''
+    Genera el contenido de una clase de caracteres de expresión regular, agrupando los caracteres en rangos.
+    '''
+    ranges = []
+    for code in sorted(ord(char) for char in chars):
+        if ranges and ranges[-1][1]==code-1:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+    return u"".join(re.escape(unichr(first)) if first==last else re.escape(unichr(first))+u"-"+re.escape(unichr(last)) for first, last in ranges)
+
+# separa la consulta en palabras, caracteres especiales (parentesis y comillas) y grupos de separadores
+QUERY_TOKENIZER = re.compile(u"([^%s]+)|([%s])|([%s]+)" % (_char_class(NON_TEXT_CHARS), _char_class(QUERY_SPECIAL_CHARS),
+                                                         _char_class(NON_TEXT_CHARS.difference(QUERY_SPECIAL_CHARS))), re.UNICODE)
+QUERY_END_TOKEN = (("", "\0", ""),)
+NGRAM_SEARCHER = re.compile(u"[%s-%s]" % (unichr(0x3000), unichr(0x2FA1E)), re.UNICODE) if NGRAM_CHARS else None
+
+def _build_query_words():
+    '''
+    Genera la tabla de palabras conocidas de las consultas, con el tipo de filtro al que corresponde cada
+    palabra y su valor. Incluye las variantes en singular y plural de tags y grupos de origenes.
+    '''
+    query_words = defaultdict(dict)
+    for kind, words in (("tag", ALL_TAGS), ("source_group", SOURCE_GROUPS)):
+        # variantes en singular y plural, con menos prioridad que la palabra exacta
+        for word in words:
+            query_words[word+"s"][kind] = word
+            if word.endswith("s") and len(word)>1 and not word.endswith("ss"):
+                query_words[word[:-1]][kind] = word
+        for word in words:
+            query_words[word][kind] = word
+
+    for word in CONTENTS_CATEGORY:
+        query_words[word]["content_type"] = word
+
+    for word in ALL_FORMATS:
+        query_words[word]["format"] = word
+
+    return dict(query_words)
+
+QUERY_WORDS = _build_query_words()
+NO_QUERY_WORD = {}
+
+# plan compilado de una consulta, compartido entre busquedas con el mismo texto (no debe modificarse)
+QueryPlan = namedtuple("QueryPlan", ["query_parts", "canonical_parts", "seen_words", "canonical_words", "computable"])
+
 # arregla problemas de codificación de la version de sphinx
 SPHINX_WRONG_RANGE = re.compile("\xf0([\x80-\x8f])")
 def fixer(char):
@@ -37,6 +88,41 @@ def escape_string(text):
 def ngram_separator(x):
     return x if x in NGRAM_CHARS else False
 
+def build_words_index(words):
+    '''
+    Agrupa palabras por longitud, ordenadas alfabeticamente, para buscar en ellas con closest_word.
+    '''
+    words_index = defaultdict(list)
+    for word in set(words):
+        words_index[len(word)].append(word)
+    for bucket in words_index.itervalues():
+        bucket.sort()
+    return words_index
+
+def closest_word(word, words_index):
+    '''
+    Busca la palabra mas parecida a la dada en un indice de palabras por longitud.
+    La distancia es 3 por cada caracter de diferencia de longitud mas 1 por cada caracter distinto en la parte comun.
+    En caso de empate devuelve la menor alfabeticamente.
+    Recorre las longitudes de mas a menos proximas y termina cuando la diferencia de longitud no puede mejorar la distancia.
+    '''
+    length = len(word)
+    best_distance = best_word = None
+    for length_distance, bucket_length in sorted((3*abs(length-bucket_length), bucket_length) for bucket_length in words_index):
+        if best_word is not None and length_distance>best_distance:
+            break
+
+        for aword in words_index[bucket_length]:
+            distance = length_distance + sum(imap(ne, word, aword))
+            if best_word is None or distance<best_distance or (distance==best_distance and aword<best_word):
+                best_distance = distance
+                best_word = aword
+
+                # no hay palabras mas parecidas en esta longitud
+                if distance==length_distance:
+                    break
+    return best_word
+
 class Search(object):
     def __init__(self, proxy, original_text, filters={}, start=True, group=True, no_group=False, limits=None, order=None, dynamic_tags=None):
         self.proxy = proxy
@@ -52,15 +138,59 @@ class Search(object):
         self.order = order or (None, None, None)
 
         # normaliza texto de busqueda
-        computable = True
-        text = filter_tags = ntts = None
-        options = []
+        text = original_text.strip().lower()
+
+        # obtiene el plan de la consulta de cache o lo compila
+        plan_key = (text, frozenset(dynamic_tags) if dynamic_tags else None)
+        plan = self.proxy.query_plans.get(plan_key)
+        if plan is None:
+            plan = self._compile_query(text, dynamic_tags)
+            self.proxy.query_plans.set(plan_key, plan)
+
+        query_parts = plan.query_parts
+        self.canonical_parts = plan.canonical_parts
+        self.seen_words = plan.seen_words
+        self.canonical_words = plan.canonical_words
+        self.computable = plan.computable
+
+        # parsea filtros
+        self.filters = {}
+        if filters:
+            if 'type' in filters:
+                self.filters['ct'] = [sphinx_type for atype in filters["type"] for sphinx_type in CONTENTS_CATEGORY[atype]]
+
+            if 'size' in filters:
+                sizes = filters["size"]
+                self.filters['z'] = [float(sizes[0]),float(sizes[1])]
+
+            if "src" in filters:
+                self.filters["src"] = self.proxy.get_sources_filter(filters["src"])
+
+        text_query_parts = []
+        last_part_type = None
+        for part_type, part_value in query_parts:
+            if part_type=="G":
+                text_query_parts.append("("+" | ".join(FIELD_NAMES[key]+value for key, value in part_value)+")")
+            elif last_part_type == part_type: # evita repetir nombres de campos
+                text_query_parts.append(part_value)
+            else:
+                text_query_parts.append(FIELD_NAMES[part_type]+part_value)
+            last_part_type = part_type
+        text = " ".join(text_query_parts).encode("utf-8")
+
+        self.query = self.proxy.sphinx.build_query(text, self.filters, self.limits, self.grouping, self.order)
+
+        if start and self.computable:
+            self.proxy.sphinx.start_search(self.query)
+
+    def _compile_query(self, text, dynamic_tags=None):
+        '''
+        Analiza el texto de busqueda y genera el plan de la consulta.
+        '''
         position = 0
         query_parts = []
         seen_filters = set()
 
-        text = original_text.strip().lower()
-
         for mode, not_mode, has_ngrams, part_words in self.parse_query(text):
             # prefijo - para las busquedas negativas
             not_prefix = "-" if not_mode else ""
@@ -81,8 +211,11 @@ class Search(object):
                     # modo intuicion?
                     guess_mode = mode==True and words_count==1
 
+                    # tipos de filtro que puede representar la palabra
+                    word_kinds = QUERY_WORDS.get(first_word, NO_QUERY_WORD)
+
                     # mira si es un tipo de contenido
-                    if not guess_mode and mode and words_count==1 and first_word in CONTENTS_CATEGORY.iterkeys():
+                    if not guess_mode and mode and words_count==1 and "content_type" in word_kinds:
                         current_filter = FILTER_PREFIX_CONTENT_TYPE.lower()+first_word
                         if current_filter in seen_filters: # no procesa dos veces el mismo filtro
                             mode = guess_mode # procesa como texto esta palabra
@@ -100,12 +233,7 @@ class Search(object):
                     # mira si se trata de un tag
                     if mode and words_count==1:
                         tags_prefix = FILTER_PREFIX_TAGS
-                        if first_word in ALL_TAGS:
-                            tag_word = first_word
-                        else:
-                            tag_word = first_word[:-1] if first_word.endswith("s") else first_word+"s"
-                            if not tag_word in ALL_TAGS:
-                                tag_word = None
+                        tag_word = word_kinds.get("tag")
 
                         # si no es un tag, mira si está en los tags dinámicos
                         if not guess_mode and not tag_word and dynamic_tags:
@@ -143,12 +271,7 @@ class Search(object):
 
                     # mira si se trata de un grupo de origenes
                     if mode and words_count==1:
-                        if first_word in SOURCE_GROUPS:
-                            source_group = first_word
-                        else:
-                            source_group = first_word[:-1] if first_word.endswith("s") else first_word+"s"
-                            if not source_group in SOURCE_GROUPS:
-                                source_group = None
+                        source_group = word_kinds.get("source_group")
 
                         if source_group:
                             current_filter = FILTER_PREFIX_SOURCE_GROUP.lower()+source_group
@@ -175,7 +298,7 @@ class Search(object):
                                 mode = False
 
                     # mira si es un formato
-                    if mode and (words_count<3 and guess_mode and first_word in ALL_FORMATS) or (not guess_mode and words_count==2 and first_word=="format" and part_words[1].lower() in ALL_FORMATS):
+                    if mode and (words_count<3 and guess_mode and "format" in word_kinds) or (not guess_mode and words_count==2 and first_word=="format" and "format" in QUERY_WORDS.get(part_words[1].lower(), NO_QUERY_WORD)):
                         current_filter = FILTER_PREFIX_FORMAT.lower()+(first_word if guess_mode else part_words[1].lower())
                         if current_filter in seen_filters:
                             mode = guess_mode # procesa como texto esta palabra
@@ -314,116 +437,74 @@ class Search(object):
                     else:
                         query_parts.append(("T", not_prefix+"\""+escape_string(all_words)+"\""))
                         self.canonical_parts.append(not_prefix+"\""+"_".join(mask)+"\"")
-        self.canonical_words = position
-
-        # parsea filtros
-        self.filters = {}
-        if filters:
-            if 'type' in filters:
-                self.filters['ct'] = [sphinx_type for atype in filters["type"] for sphinx_type in CONTENTS_CATEGORY[atype]]
-
-            if 'size' in filters:
-                sizes = filters["size"]
-                self.filters['z'] = [float(sizes[0]),float(sizes[1])]
-
-            if "src" in filters:
-                groups={"s":"streaming","w":"download","f":"download","p":"p2p","g":"gnutella","t":"torrent","e":"ed2k"}
-                src = filters["src"]
-                self.filters["src"] = [source_id for source_id, source in self.proxy.sources.iteritems()
-                        if source["d"][:source["d"].rfind(".")] in src #esta el dominio en la URL
-                        or any(group in groups and groups[group] in src for group in source["g"]) #si viene el origen en vez del suborigen
-                        or ("other-streamings" in src and source["d"] not in self.proxy.sources_relevance_streaming[:8] and "s" in source["g"]) #si viene other... y no esta en la lista de sources y el source tiene streaming
-                        or ("other-downloads" in src and source["d"] not in self.proxy.sources_relevance_download[:8] and ("w" in source["g"] or "f" in source["g"])) #si viene other... y no esta en la lista de sources y el source tiene web
-                ]
-
-        text_query_parts = []
-        last_part_type = None
-        for part_type, part_value in query_parts:
-            if part_type=="G":
-                text_query_parts.append("("+" | ".join(FIELD_NAMES[key]+value for key, value in part_value)+")")
-            elif last_part_type == part_type: # evita repetir nombres de campos
-                text_query_parts.append(part_value)
-            else:
-                text_query_parts.append(FIELD_NAMES[part_type]+part_value)
-            last_part_type = part_type
-        text = " ".join(text_query_parts).encode("utf-8")
-
-        self.query = self.proxy.sphinx.build_query(text, self.filters, self.limits, self.grouping, self.order)
 
-        if start and self.computable:
-            self.proxy.sphinx.start_search(self.query)
+        return QueryPlan(tuple(query_parts), tuple(self.canonical_parts), self.seen_words, position, self.computable)
 
     def parse_query(self, query):
         # inicializa variables
-        acum = []                   # palabra actual
+        acum = None                 # palabra actual
         all_acums = []              # lista de palabras a devolver
-        yield_mode = False
 
-        valid_acum = 0              # contador de caracteres validos, para evitar hacer consultas de una sola letra
         not_mode = False            # indica que esta parte de la consulta está en modo negativo
         quote_mode = False          # indica que esta parte de la consulta va en entre comillas
         tag_mode = False            # indica que esta parte de la consulta es un tag
-        any_not_blend_char = False  # indica que alguna letra de la palabra no es un blend char
-        any_ngram = False           # indica que alguna letra de la palabra es un n-grama
+        any_ngram = False           # indica que alguna letra de la parte es un n-grama
         any_not_not_part = False    # indica que alguna parte de la consulta no está en modo negativo
 
-        # recorre caracteres (añade un espacio para considerar la ultima palabra)
-        for ch in query.replace("\0","")+"\0":
-            if not acum and (ch=="-" or ch=="!"): # operador not
-                not_mode = True
-            elif ch=="(" and not tag_mode and not quote_mode:
+        # recorre palabras, caracteres especiales y separadores (añade un final para considerar la ultima palabra)
+        for word, special, separator in chain(QUERY_TOKENIZER.findall(query.replace("\0","")), QUERY_END_TOKEN):
+            if word:
+                # operador not al principio de la palabra
+                acum = word.lstrip(NOT_CHARS_STRING)
+                if len(acum)<len(word):
+                    not_mode = True
+                if acum and NGRAM_SEARCHER and NGRAM_SEARCHER.search(acum):
+                    any_ngram = True
+                continue # la palabra se devuelve con el siguiente separador
+            elif special=="(" and not tag_mode and not quote_mode:
                 yield_mode = True
                 tag_mode = True
-            elif ch==")" and tag_mode:
+            elif special==")" and tag_mode:
                 yield_mode = "("
                 tag_mode = False
-            elif ch=="\"": # comillas
+            elif special=="\"": # comillas
                 if quote_mode:
                     yield_mode = "\"" # indica que incluya comillas en el resultados
                 else:
                     yield_mode = True
                 quote_mode = not quote_mode
-            elif ch=="\0":
+            elif special=="\0":
                 yield_mode = "(" if tag_mode else "\"" if quote_mode else True
                 tag_mode = quote_mode = False
-            elif ch in NON_TEXT_CHARS: # separadores de palabras fuera de comillas
+            else: # separadores de palabras fuera de comillas
                 # el menos no puede estar separado para negar
-                if not acum and not_mode:
+                if not acum:
                     not_mode = False
 
                 if not quote_mode and not tag_mode:
                     yield_mode = True
                 else:
                     yield_mode = " "
-            else: # resto de caracters
-                valid_acum += 1
-                any_not_blend_char = any_not_blend_char or ch not in BLEND_CHARS
-                any_ngram = any_ngram or ch in NGRAM_CHARS
-                acum.append(ch)
-
-            # si toca devolver resultado, lo hace
-            if yield_mode:
-                acum_result = "".join(acum) if acum and valid_acum else False
-
-                # acumula palabras
-                if acum_result:
-                    if any_ngram:
-                        all_acums.append(["".join(i[1]) for i in groupby(acum_result, ngram_separator)])
-                    else:
-                        all_acums.append(acum_result)
-                    any_not_not_part = any_not_not_part or (not not_mode and (any_ngram or
-                                                                            (any_not_blend_char and valid_acum>=WORD_SEARCH_MIN_LEN)))
-                    del acum[:]
-                    valid_acum = 0
-                    any_not_blend_char = False
 
-                # devuelve palabras
-                if yield_mode!=" " and all_acums:
-                    yield (yield_mode, not_mode, any_ngram, all_acums)
-                    all_acums = []
-                    any_ngram = not_mode = False
+            # acumula palabras
+            if acum:
+                if any_ngram:
+                    all_acums.append(["".join(i[1]) for i in groupby(acum, ngram_separator)])
+                else:
+                    all_acums.append(acum)
+                any_not_not_part = any_not_not_part or (not not_mode and (any_ngram or
+                                                                        (len(acum)>=WORD_SEARCH_MIN_LEN and acum.strip(BLEND_CHARS_STRING))))
+                acum = None
+
+            # devuelve palabras
+            if yield_mode!=" " and all_acums:
+                yield (yield_mode, not_mode, any_ngram, all_acums)
+                all_acums = []
+                any_ngram = not_mode = False
 
-                yield_mode = False
+            # a partir del segundo separador seguido ya no hay palabra que negar
+            if len(separator)>1:
+                not_mode = False
 
         # si no se han devuelto partes no negativas, la consulta no es computable
         if not any_not_not_part:
@@ -464,8 +545,10 @@ class Search(object):
                 new_word_list[word_positions[word]] = word
                 del word_positions[word]
 
-        for word, position in word_positions.iteritems():
-            new_word_list[position] = min((3*abs(len(word)-len(aword))+sum(1 for w1,w2 in zip(word,aword) if w1!=w2),aword) for aword in word_list)[1]
+        if word_positions:
+            words_index = build_words_index(word_list)
+            for word, position in word_positions.iteritems():
+                new_word_list[position] = closest_word(word, words_index)
 
         self.stats["ct"] = u"_".join(self.canonical_parts).format(*new_word_list)
 
@@ -474,4 +557,3 @@ class Search(object):
 
     def block_files(self, ids):
         return None
-
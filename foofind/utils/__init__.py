@@ -60,6 +60,70 @@ class LimitedSizeDict(OrderedDict):
             while len(self) > self.size_limit:
                 self.popitem(last=False)
 
+class LRUCache(object):
+    '''
+    Diccionario de tamaño limitado que descarta los elementos usados hace más
+    tiempo. Es seguro entre hilos y lleva la cuenta de aciertos, fallos y
+    descartes para poder dimensionarlo.
+    '''
+    def __init__(self, size_limit):
+        self.size_limit = size_limit
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        '''
+        Obtiene el valor de una clave y la marca como usada recientemente.
+        '''
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        '''
+        Asigna el valor de una clave, descartando las menos usadas si se supera el límite.
+        '''
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size_limit:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self, reset=False):
+        '''
+        Devuelve los contadores de uso del caché.
+
+        @type reset: bool
+        @param reset: reinicia los contadores tras leerlos
+        '''
+        with self._lock:
+            result = {"hits":self.hits, "misses":self.misses, "evictions":self.evictions, "size":len(self._data)}
+            if reset:
+                self.hits = self.misses = self.evictions = 0
+        return result
+
 class Parallel(object):
     '''
     Objeto paralelizador de tareas.
@@ -573,6 +637,16 @@ def generator_with_callback(iterator, callback):
         yield i
     callback()
 
+def freeze(value):
+    '''
+    Convierte un valor de un documento en una estructura inmutable comparable.
+    '''
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.iteritems()))
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
 def u(txt):
     ''' Parse any basestring (ascii str, encoded str, or unicode) to unicode '''
     if isinstance(txt, unicode):
@@ -1,5 +1,7 @@
 import newrelic.agent
-from . import logging
+import threading
+from time import time
+from . import logging, LRUCache
 from hashlib import md5
 from flask import g, request, abort, current_app
 from foofind.services import *
@@ -24,27 +26,121 @@ def is_full_browser():
     '''
     return request.user_agent.browser in _FULL_BROWSERS_USER_AGENTS
 
+class RateLimiter(object):
+    '''
+    Contador de peticiones por cliente en ventanas de tiempo, compartido entre procesos.
+
+    Cada proceso cuenta localmente las peticiones de cada cliente y las suma a los contadores
+    de memcache por lotes, cuando acumula un número de peticiones o pasa un tiempo desde la
+    última sincronización. Los límites son aproximadamente globales y la mayoría de peticiones
+    no necesitan acceder a la red.
+    '''
+    def __init__(self):
+        self.window = 60
+        self.sync_batch = 1
+        self.sync_interval = 0
+        self.counters = LRUCache(50000)
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def init_app(self, app, eventmanager):
+        '''
+        Inicializa el contador a partir de la configuración de la aplicación.
+        '''
+        self.app = app
+        self.sync_batch = app.config["RATE_LIMIT_SYNC_BATCH"]
+        self.sync_interval = app.config["RATE_LIMIT_SYNC_INTERVAL"]
+        self.counters = LRUCache(app.config["RATE_LIMIT_CLIENTS"])
+        eventmanager.interval(self.sync_interval, self.sync_all)
+
+    def hit(self, key):
+        '''
+        Cuenta una petición de un cliente.
+
+        @type key: str
+        @param key: clave del cliente
+
+        @rtype tuple
+        @return número aproximado de peticiones del cliente en la ventana actual entre todos los procesos,
+                antes y después de esta petición
+        '''
+        now = time()
+        counter = self.counters.get(key)
+        if counter is None or now-counter[0]>=self.window:
+            # las peticiones sin sincronizar de la ventana anterior no se pierden
+            if counter and counter[1]:
+                self._sync(key, counter, now)
+            # inicio de la ventana, peticiones sin sincronizar, cuenta global, última sincronización y último valor devuelto
+            counter = [now, 0, 0, now, 0]
+            self.counters.set(key, counter)
+
+        with self._lock:
+            counter[1] += 1
+            current = counter[1]+counter[2]
+            sync = counter[1]>=self.sync_batch or now-counter[3]>=self.sync_interval
+            if not sync:
+                self._pending.add(key)
+
+        if sync:
+            current = self._sync(key, counter, now)
+
+        with self._lock:
+            previous = counter[4]
+            counter[4] = max(previous, current)
+        return previous, current
+
+    def _sync(self, key, counter, now):
+        with self._lock:
+            amount = counter[1]
+            counter[1] = 0
+            counter[3] = now
+
+        if amount:
+            current = cache.inc(key, amount) # devuelve None si no existe la clave
+            if current is None:
+                current = amount if cache.add(key, amount, timeout=self.window) else cache.inc(key, amount)
+
+        with self._lock:
+            if amount:
+                counter[2] = max(counter[2]+amount, current or 0)
+            return counter[1]+counter[2]
+
+    def sync_all(self):
+        '''
+        Suma a memcache las peticiones pendientes de todos los clientes.
+        '''
+        with self._lock:
+            keys = self._pending
+            self._pending = set()
+
+        now = time()
+        with self.app.app_context():
+            for key in keys:
+                counter = self.counters.get(key)
+                if counter and counter[1]:
+                    self._sync(key, counter, now)
+
+ratelimiter = RateLimiter()
+
 def check_rate_limit(search_bot):
     '''
     Hace que se respeten los limites de peticiones.
     '''
     if search_bot: # robots
-        if not cache.add("rlimit_bot_"+search_bot, 1, timeout=60):
-            rate_limit = current_app.config["ROBOT_USER_AGENTS_RATE_LIMIT"].get(search_bot, current_app.config["ROBOT_DEFAULT_RATE_LIMIT"])
-            current = cache.inc("rlimit_bot_"+search_bot) # devuelve None si no existe la clave
-            if current and current > rate_limit:
-                if (current%rate_limit)==1:
-                    logging.warn("Request rate over limit %d times from bot %s."%(int(current/rate_limit),search_bot))
-                newrelic.agent.ignore_transaction()
-                abort(429)
+        previous, current = ratelimiter.hit("rlimit_bot_"+search_bot)
+        rate_limit = current_app.config["ROBOT_USER_AGENTS_RATE_LIMIT"].get(search_bot, current_app.config["ROBOT_DEFAULT_RATE_LIMIT"])
+        if current > rate_limit:
+            # avisa al pasar cada múltiplo del límite, la cuenta puede avanzar varias peticiones de golpe al sincronizar
+            if previous/rate_limit < current/rate_limit:
+                logging.warn("Request rate over limit %d times from bot %s."%(int(current/rate_limit),search_bot))
+            newrelic.agent.ignore_transaction()
+            abort(429)
     else: # resto
-       ip = request.headers.getlist("X-Forwarded-For")[0] if request.headers.getlist("X-Forwarded-For") else request.remote_addr
-       client_id = md5(ip).hexdigest()
-       if not cache.add("rlimit_user_"+client_id, 1, timeout=60):
-            current = cache.inc("rlimit_user_"+client_id) # devuelve None si no existe la clave
-            rate_limit = current_app.config["USER_RATE_LIMIT"]
-            if current and current > rate_limit:
-                if (current%rate_limit)==1:
-                    user_agent = request.user_agent.string
-                    logging.warn("Request rate over limit %d times from user %s."%(int(current/rate_limit),client_id))
-                abort(429)
+        ip = request.headers.getlist("X-Forwarded-For")[0] if request.headers.getlist("X-Forwarded-For") else request.remote_addr
+        client_id = md5(ip).hexdigest()
+        previous, current = ratelimiter.hit("rlimit_user_"+client_id)
+        rate_limit = current_app.config["USER_RATE_LIMIT"]
+        if current > rate_limit:
+            if previous/rate_limit < current/rate_limit:
+                logging.warn("Request rate over limit %d times from user %s."%(int(current/rate_limit),client_id))
+            abort(429)
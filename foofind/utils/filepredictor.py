@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 
 from collections import defaultdict
+from hashlib import md5
 from splitter import SEPPER, seppersplit
-from . import to_seconds, content_types as ct, u
+from . import to_seconds, content_types as ct, u, LRUCache, freeze
 
 import operator
 import itertools
@@ -651,12 +652,143 @@ ALL_TAGS = set(tag
 ALL_TAGS.update(TAG_CONTENT_TYPE.iterkeys())
 ALL_TAGS.update(TAG_CONTENT_TYPE_GUESS.iterkeys())
 
+def _keyword_match(keyword):
+    '''
+    Combina lo que implica una palabra clave en todas las tablas: pesos por tipo
+    de contenido, tags y formatos.
+    '''
+    return (tuple(REVERSE_FILENAME_KEYWORDS.get(keyword, {}).iteritems()),
+            frozenset(REVERSE_TAG_KEYWORDS.get(keyword, ())),
+            tuple(REVERSE_FORMAT_KEYWORDS.get(keyword, ())))
+
+# Trie de palabras clave de todas las tablas: cada palabra lleva a lo que implica
+# por si sola y a las palabras que pueden seguirla para formar una pareja
+KEYWORDS_AUTOMATON = {}
+for keyword in set(itertools.chain(REVERSE_FILENAME_KEYWORDS, REVERSE_TAG_KEYWORDS, REVERSE_FORMAT_KEYWORDS)):
+    if isinstance(keyword, tuple):
+        first, second = keyword
+        KEYWORDS_AUTOMATON.setdefault(first, [None, {}])[1][second] = _keyword_match(keyword)
+    else:
+        KEYWORDS_AUTOMATON.setdefault(keyword, [None, {}])[0] = _keyword_match(keyword)
+del keyword
+
+def match_keywords(fn):
+    '''
+    Busca en un nombre de fichero las palabras clave y parejas de palabras clave
+    de todas las tablas en una sola pasada.
+
+    @type fn: unicode
+    @param fn: nombre de fichero en minúsculas
+
+    @rtype list
+    @return lo que implica cada palabra clave encontrada, primero las palabras y luego las parejas
+    '''
+    matches = []
+    pair_matches = []
+    followers = None
+    automaton_get = KEYWORDS_AUTOMATON.get
+    for word in seppersplit(fn):
+        if not word:
+            continue
+        if followers and word in followers:
+            pair_matches.append(followers[word])
+        node = automaton_get(word)
+        if node is None:
+            followers = None
+            continue
+        single, followers = node
+        if single:
+            matches.append(single)
+    matches.extend(pair_matches)
+    return matches
+
 _scores_empty = [0.0] * len(CONTENT_TYPE_SET)
 _depths_empty = [sys.maxint] * len(CONTENT_TYPE_SET)
 _scores_initial = _scores_empty[:]
 _scores_initial[ct.CONTENT_UNKNOWN] = CONTENT_UNKNOWN_THRESHOLD
 _formats_initial = defaultdict(float, ((None, 0),))
 
+# Caches de análisis por ruta de fichero y por documento
+FILENAME_ANALYSIS_CACHE_SIZE = 200000
+DOC_CONTENT_TYPE_CACHE_SIZE = 50000
+_filename_analysis_cache = LRUCache(FILENAME_ANALYSIS_CACHE_SIZE)
+_doc_content_type_cache = LRUCache(DOC_CONTENT_TYPE_CACHE_SIZE)
+
+def _analyze_filename(fn, counts, skip_ct, analyze_extensions):
+    '''
+    Analiza una ruta de fichero ya normalizada.
+
+    @rtype tuple
+    @return tipo de contenido elegido para el fichero (o None), profundidad,
+            tags y lista de incrementos de formatos en orden
+    '''
+    tags = set()
+    fileformats = []
+    not_skip_ct = not skip_ct
+    if not_skip_ct:
+        file_scores = _scores_empty[:]
+
+    if "/" in fn:
+        path, fn = fn.rsplit("/", 1)
+        depth = path.count("/") + 2
+    else:
+        depth = 1
+
+    # Análisis de extensiones
+    if analyze_extensions and "." in fn:
+        # Al menos un punto para poder analizar extensiones
+        parts = fn.split(".")
+        parts.reverse()
+        # Extensiones en orden inverso
+        exts = tuple(itertools.takewhile(ct.EXTENSIONS.__contains__, parts[:-1]))
+        # Nombre de fichero sin extensiones
+        fn = ".".join(parts[:len(exts)-1:-1])
+        # Tags por extensiones
+        tags.update(
+            tag
+            for ext in exts if ext in REVERSE_TAG_EXTENSIONS
+                for tag in REVERSE_TAG_EXTENSIONS[ext]
+            )
+        # Formato por la primera extensión válida
+        for ext in exts:
+            # Formato dado manualmente por extensión
+            if ext in REVERSE_FORMAT_EXTENSIONS:
+                for fformat in REVERSE_FORMAT_EXTENSIONS[ext]:
+                    fileformats.append((fformat, FORMAT_EXTENSIONS_WEIGHT))
+                break
+            # Formato dado automáticamente por extensión
+            if not ext in FORMAT_EXTENSIONS_AUTO_BLACKLIST:
+                sitf = False
+                for extype in ct.EXTENSIONS[ext]:
+                    if not extype in FORMAT_EXTENSIONS_AUTO_BLACKLIST_CT:
+                        fileformats.append(((ext, None), FORMAT_EXTENSIONS_AUTO_WEIGHT))
+                        sitf = True
+                if sitf:
+                    break
+        # Tipo de contenido por extensión
+        if exts and not_skip_ct:
+            extweight = 2
+            for ext in exts:
+                for extype in ct.EXTENSIONS[ext]:
+                    if extype not in EXTENSION_BLACKLIST_CT:
+                        file_scores[extype] += EXTENSION_CONFIDENCE.get(ext, EXTENSION_CONFIDENCE_DEFAULT) * counts * extweight
+                        extweight *= EXTENSION_IMPORTANCE_POSITION
+
+    # Análisis de nombre de fichero
+    if fn:
+        # Puntuación según palabras clave
+        for ct_weights, keyword_tags, keyword_formats in match_keywords(fn):
+            if not_skip_ct:
+                for ctenum, weight in ct_weights:
+                    file_scores[ctenum] += weight * counts
+            tags.update(keyword_tags)
+            for fformat in keyword_formats:
+                fileformats.append((fformat, FORMAT_KEYWORDS_WEIGHT))
+
+    # Tipo de contenido del fichero
+    ict = max(_content_type_xrange, key=file_scores.__getitem__) if not_skip_ct else None
+    return ict, depth, frozenset(tags), tuple(fileformats)
+
 def analyze_filenames(filenames, filesizes, skip_ct=False, analyze_extensions=True):
     '''
     Develve una lista de tipos de contenido y tags dependiendo de la profundidad
@@ -686,88 +818,26 @@ def analyze_filenames(filenames, filesizes, skip_ct=False, analyze_extensions=Tr
     filesizes_reverse.reverse()
     filesizes_sum = sum(float(asize) for asize in filesizes_reverse) or 1
 
-    # Análisis de extensiones
+    cache_get = _filename_analysis_cache.get
+    cache_set = _filename_analysis_cache.set
     for fn, counts in filenames:
-        # Puntuaciones locales de fichero
-        if not_skip_ct:
-            file_scores = _scores_empty[:]
         # No tenemos en cuenta mayúsculas/minúsculas
         fn = fn.strip().lower().replace("\\", "/")
-        if "/" in fn:
-            path, fn = fn.rsplit("/", 1)
-            depth = path.count("/") + 2
-        else:
-            depth = 1
-
-        # Análisis de extensiones
-        if analyze_extensions and "." in fn:
-            # Al menos un punto para poder analizar extensiones
-            parts = fn.split(".")
-            parts.reverse()
-            # Extensiones en orden inverso
-            exts = tuple(itertools.takewhile(ct.EXTENSIONS.__contains__, parts[:-1]))
-            # Nombre de fichero sin extensiones
-            fn = ".".join(parts[:len(exts)-1:-1])
-            # Tags por extensiones
-            tags.update(
-                tag
-                for ext in exts if ext in REVERSE_TAG_EXTENSIONS
-                    for tag in REVERSE_TAG_EXTENSIONS[ext]
-                )
-            # Formato por la primera extensión válida
-            for ext in exts:
-                # Formato dado manualmente por extensión
-                if ext in REVERSE_FORMAT_EXTENSIONS:
-                    for fformat in REVERSE_FORMAT_EXTENSIONS[ext]:
-                        fileformats[fformat] += FORMAT_EXTENSIONS_WEIGHT
-                    break
-                # Formato dado automáticamente por extensión
-                if not ext in FORMAT_EXTENSIONS_AUTO_BLACKLIST:
-                    sitf = False
-                    for extype in ct.EXTENSIONS[ext]:
-                        if not extype in FORMAT_EXTENSIONS_AUTO_BLACKLIST_CT:
-                            fileformats[ext, None] += FORMAT_EXTENSIONS_AUTO_WEIGHT
-                            sitf = True
-                    if sitf:
-                        break
-            # Tipo de contenido por extensión
-            if exts and not_skip_ct:
-                extweight = 2
-                for ext in exts:
-                    for extype in ct.EXTENSIONS[ext]:
-                        if extype not in EXTENSION_BLACKLIST_CT:
-                            file_scores[extype] += EXTENSION_CONFIDENCE.get(ext, EXTENSION_CONFIDENCE_DEFAULT) * counts * extweight
-                            extweight *= EXTENSION_IMPORTANCE_POSITION
-
-        # Análisis de nombre de fichero
-        if fn:
-            # Puntuación según palabras clave
-            singlesplit = filter(None, seppersplit(fn))
-            doublesplit = itertools.izip(singlesplit, itertools.islice(singlesplit, 1, sys.maxint)) if len(singlesplit) > 1 else ()
-            if skip_ct:
-                for splitted_words in (singlesplit, doublesplit):
-                    for word in splitted_words:
-                        if word in REVERSE_TAG_KEYWORDS:
-                            tags.update(tag for tag in REVERSE_TAG_KEYWORDS[word])
-                        if word in REVERSE_FORMAT_KEYWORDS:
-                            for fformat in REVERSE_FORMAT_KEYWORDS[word]:
-                                fileformats[fformat] += FORMAT_KEYWORDS_WEIGHT
-            else:
-                # Contador para saber si hay más de uno
-                for splitted_words in (singlesplit, doublesplit):
-                    for word in splitted_words:
-                        if word in REVERSE_FILENAME_KEYWORDS:
-                            for ctenum, weight in REVERSE_FILENAME_KEYWORDS[word].iteritems():
-                                file_scores[ctenum] += weight * counts
-                        if word in REVERSE_TAG_KEYWORDS:
-                            tags.update(tag for tag in REVERSE_TAG_KEYWORDS[word])
-                        if word in REVERSE_FORMAT_KEYWORDS:
-                            for fformat in REVERSE_FORMAT_KEYWORDS[word]:
-                                fileformats[fformat] += FORMAT_KEYWORDS_WEIGHT
+
+        # El análisis de cada fichero solo depende de su ruta, sus repeticiones y las opciones
+        key = (fn, None if skip_ct else counts, analyze_extensions)
+        analysis = cache_get(key)
+        if analysis is None:
+            analysis = _analyze_filename(fn, counts, skip_ct, analyze_extensions)
+            cache_set(key, analysis)
+        ict, depth, file_tags, file_formats = analysis
+
+        tags.update(file_tags)
+        for fformat, weight in file_formats:
+            fileformats[fformat] += weight
 
         # Análisis de content type del fichero
         if not_skip_ct:
-            ict = max(_content_type_xrange, key=file_scores.__getitem__)
             scores[ict] += float(filesizes_reverse.pop())/filesizes_sum if filesizes_reverse else 1
             if lower_depths[ict] > depth:
                 lower_depths[ict] = depth
@@ -856,9 +926,63 @@ def restrict_content_type(scores, tags=(), fformats=(), ctype=None):
         ftags = []
     return ctype, ftags, fformat
 
+# metadatos cuyo valor se usa al obtener el tipo de contenido, del resto solo se usa la clave
+_doc_content_type_md_values = frozenset(REVERSE_TAG_METADATA).union(("torrent:filepaths", "torrent:filesizes",
+                                                                    "torrent:special_tags", "torrent:category", "video:height"))
+
+def _doc_content_type_key(doc, sources):
+    '''
+    Clave del cache de tipos de contenido: id del documento y resumen de los campos usados
+    al obtener el tipo y de la configuración de sus orígenes.
+    '''
+    md = doc.get("md")
+    md_key = tuple(sorted(
+        (key, freeze(value) if key in _doc_content_type_md_values else None)
+        for key, value in md.iteritems())) if md else None
+    fn_key = tuple(sorted(
+        (key, fn.get("n"), fn.get("x"))
+        for key, fn in doc["fn"].iteritems())) if "fn" in doc else None
+    src_key = tuple(sorted(
+        (src.get("t"), src.get("url"), tuple(sorted((key, fn.get("m", 1)) for key, fn in src["fn"].iteritems())) if "fn" in src else None)
+        for src in doc["src"].itervalues())) if "src" in doc else None
+
+    source_config = None
+    if sources and "src" in doc:
+        source_config = tuple(
+            (sourceid, sources[sourceid].get("hidden_extensions"), freeze(sources[sourceid].get("ct")))
+            for sourceid in sorted({int(src["t"]) for src in doc["src"].itervalues() if "t" in src})
+                if sourceid in sources)
+    # se guarda un resumen de los campos en lugar de los campos para no ocupar memoria en el cache
+    return doc.get("_id"), md5(repr((md_key, fn_key, src_key, doc.get("ct"), doc.get("s"), source_config))).digest()
+
+def _copy_content_type(result):
+    # las listas de tags se devuelven copiadas para que no se modifique el cache
+    return tuple(list(value) if isinstance(value, list) else value for value in result)
+
+def guess_doc_content_type(doc, sources=None):
+    '''
+    Obtiene el content type e información relacionada de un documento de fichero,
+    reutilizando el resultado si el documento no ha cambiado.
+
+    @type doc: dict
+    @param doc: documento de mongodb de fichero
+    @type sources: dict
+    @param sources: diccionario de sources
+
+    @rtype tuple
+    @return tupla con id de tipo de contenido (int), lista de tags, y formato
+            (como tupla de formato o None)
+    '''
+    key = _doc_content_type_key(doc, sources)
+    result = _doc_content_type_cache.get(key)
+    if result is None:
+        result = _guess_doc_content_type(doc, sources)
+        _doc_content_type_cache.set(key, result)
+    return _copy_content_type(result)
+
 PRIORITY_CT = 1
 PRIORITY_FILENAMES = 1
-def guess_doc_content_type(doc, sources=None):
+def _guess_doc_content_type(doc, sources=None):
     '''
     Obtiene el content type e información relacionada de un documento de fichero.
 
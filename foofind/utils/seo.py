@@ -3,14 +3,22 @@
 
 import itertools
 from . import u
+from . import splitter
 from .splitter import SEPPER, EXTENSIONS
+from .snapshot import load_tables
 from unicodedata import normalize
 
-NONSEPPER = frozenset(unichr(i) for i in xrange(0x10000) if unichr(i) not in SEPPER)
+def build_tables():
+    nonsepper = frozenset(unichr(i) for i in xrange(0x10000) if unichr(i) not in SEPPER)
 
-seoize_table = {c:normalize('NFKC', u"".join(c2 for c2 in normalize('NFKD', c) if c2 in NONSEPPER))
-                    for c in NONSEPPER}
-seoize_table = {ord(c):to for c, to in seoize_table.iteritems() if to and to!=c}
+    seoize_table = {c:normalize('NFKC', u"".join(c2 for c2 in normalize('NFKD', c) if c2 in nonsepper))
+                        for c in nonsepper}
+    seoize_table = {ord(c):to for c, to in seoize_table.iteritems() if to and to!=c}
+    return {"seoize_table": seoize_table}
+
+# tabla derivada de la base de datos unicode, se guarda en disco para no calcularla en cada proceso
+_tables = load_tables("seo", (__file__, splitter.__file__), build_tables)
+seoize_table = _tables["seoize_table"]
 
 def seoize_text(x, separator="-", is_url=False, max_length=None, min_length=20):
     # normaliza la cadena y la pasa a minusculas
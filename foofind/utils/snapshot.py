@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+'''
+    Instantáneas en disco de las tablas derivadas que se calculan al importar los módulos.
+
+    Cada instantánea se guarda con marshal en un fichero cuyo nombre lleva la versión: un hash
+    del formato, la versión de python, la de la base de datos unicode y el contenido de los
+    ficheros de los que dependen las tablas. Si cambia cualquiera de ellos, la instantánea se
+    vuelve a generar automáticamente la primera vez que se importa el módulo.
+'''
+import os
+import sys
+import stat
+import marshal
+import hashlib
+import tempfile
+import unicodedata
+
+# foofind.utils importa este módulo antes de definir su atributo logging, se importa el envoltorio directamente
+from foofind.utils import wlogging as logging
+
+SNAPSHOT_FORMAT = 1
+# directorio privado de la instancia de la aplicación, junto al fichero de revisión del despliegue
+SNAPSHOT_DIR = os.environ.get("FOOFIND_SNAPSHOT_DIR") or \
+    os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "instance", "tables")
+
+# instantáneas usadas en este proceso, para poder regenerarlas
+registry = {}
+
+# ficheros guardados por este proceso, son los únicos que se pueden borrar
+written = {}
+
+def _source_path(path):
+    # el módulo puede haberse cargado desde el fichero compilado
+    return path[:-1] if path.endswith((".pyc", ".pyo")) else path
+
+def snapshot_version(sources):
+    '''
+    Calcula la versión de una instantánea a partir de los ficheros de los que depende.
+
+    @type sources: iterable
+    @param sources: rutas de los ficheros
+    '''
+    version = hashlib.sha1("%d %s %s" % (SNAPSHOT_FORMAT, sys.version, unicodedata.unidata_version))
+    for path in sources:
+        path = _source_path(path)
+        version.update(os.path.basename(path))
+        try:
+            with open(path, "rb") as source:
+                version.update(source.read())
+        except IOError:
+            pass
+    return version.hexdigest()[:16]
+
+def snapshot_path(name, version):
+    return os.path.join(SNAPSHOT_DIR, "%s-%s.marshal" % (name, version))
+
+def _trusted(path):
+    '''
+    Comprueba que un fichero o directorio pertenece al usuario del proceso y que nadie más puede modificarlo.
+    '''
+    info = os.stat(path)
+    return info.st_uid == os.getuid() and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def _snapshot_dir():
+    '''
+    Crea el directorio de instantáneas con permisos restrictivos si no existe.
+
+    @rtype bool
+    @return True si el directorio es de confianza
+    '''
+    if not os.path.isdir(SNAPSHOT_DIR):
+        os.makedirs(SNAPSHOT_DIR, 0700)
+    if _trusted(SNAPSHOT_DIR):
+        return True
+    logging.warn("Untrusted tables snapshot directory %s" % SNAPSHOT_DIR)
+    return False
+
+def save_tables(name, version, tables):
+    '''
+    Guarda las tablas de una instantánea de forma atómica y borra la versión anterior
+    si la guardó este mismo proceso.
+    '''
+    path = snapshot_path(name, version)
+    try:
+        if not _snapshot_dir():
+            return
+        fd, temp_path = tempfile.mkstemp(prefix=".%s-" % name, dir=SNAPSHOT_DIR)
+        with os.fdopen(fd, "wb") as output:
+            marshal.dump(tables, output)
+        os.rename(temp_path, path)
+        old_path = written.get(name)
+        written[name] = path
+        if old_path and old_path != path:
+            os.remove(old_path)
+    except (IOError, OSError) as e:
+        logging.warn("Can't save tables snapshot %s: %s" % (name, e))
+
+def load_tables(name, sources, build):
+    '''
+    Obtiene las tablas de una instantánea, calculándolas y guardándolas si no existe
+    o si ha cambiado alguno de los ficheros de los que dependen.
+
+    @type name: str
+    @param name: nombre de la instantánea
+
+    @type sources: iterable
+    @param sources: rutas de los ficheros de los que dependen las tablas
+
+    @type build: callable
+    @param build: función que calcula las tablas, debe devolver un diccionario de valores serializables con marshal
+
+    @rtype dict
+    @return diccionario con las tablas
+    '''
+    registry[name] = (sources, build)
+    version = snapshot_version(sources)
+    path = snapshot_path(name, version)
+    try:
+        # marshal no es seguro con datos ajenos, solo se cargan ficheros propios en un directorio propio
+        if _trusted(SNAPSHOT_DIR) and _trusted(path):
+            with open(path, "rb") as snapshot:
+                return marshal.load(snapshot)
+        logging.warn("Untrusted tables snapshot %s" % path)
+    except (IOError, OSError):
+        pass
+    except (EOFError, ValueError, TypeError) as e:
+        logging.warn("Invalid tables snapshot %s: %s" % (name, e))
+
+    tables = build()
+    save_tables(name, version, tables)
+    return tables
+
+def rebuild_tables():
+    '''
+    Regenera todas las instantáneas registradas.
+    '''
+    for name, (sources, build) in registry.iteritems():
+        save_tables(name, snapshot_version(sources), build())
+
+if __name__=="__main__":
+    # paso de despliegue: genera las instantáneas antes de arrancar los procesos
+    # (se usa el módulo importado, que es donde se registran las tablas)
+    import foofind.utils.splitter, foofind.utils.seo
+    from foofind.utils import snapshot
+    snapshot.rebuild_tables()
+    for name, (sources, build) in snapshot.registry.iteritems():
+        print name, snapshot.snapshot_path(name, snapshot.snapshot_version(sources))
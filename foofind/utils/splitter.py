@@ -6,6 +6,7 @@ from itertools import izip, groupby, chain, imap, ifilterfalse
 from collections import defaultdict, Counter
 from operator import itemgetter
 from foofind.utils.content_types import *
+from foofind.utils.snapshot import load_tables
 from unicodedata import normalize
 
 split = re.compile(r"(?:[^\w\']|\_)|(?:[^\_\W]|\')+", re.UNICODE)
@@ -13,10 +14,11 @@ wsepsws = {" ":2, "_":1, "+":1, ".":1, "-":0.5}
 psepsws = {"-":2, "~":1, "\"": 0.5}
 
 sepre = re.compile(r"[^\w\']", re.UNICODE)
-# SEPPER = frozenset(unichr(i) for i in xrange(0x10000) if not (0xD7FF<i<0xE000) and sepre.match(unichr(i)) or unichr(i)=='_')
-SEPPER = sepre.findall(u"".join(imap(unichr, chain(xrange(0xD800), xrange(0xE000, 0x10000)))))
-SEPPER.append(u"_")
-SEPPER = frozenset(SEPPER)
+def build_sepper():
+    # SEPPER = frozenset(unichr(i) for i in xrange(0x10000) if not (0xD7FF<i<0xE000) and sepre.match(unichr(i)) or unichr(i)=='_')
+    sepper = sepre.findall(u"".join(imap(unichr, chain(xrange(0xD800), xrange(0xE000, 0x10000)))))
+    sepper.append(u"_")
+    return frozenset(sepper)
 
 empty_join = "".join
 space_join = " ".join
@@ -29,7 +31,47 @@ proper_case_options = {"u^": ("U",  False), "uL": ("U",  True),
                        "$L": ("$",  True),  "$D2": ("$",  True),   # fin lleva a fin desde minus o num2
                       }
 
-sepper_re = re.compile("|".join(imap(re.escape, SEPPER)))
+def char_class(chars):
+    '''
+    Expresión de clase de caracteres compacta, por rangos, para un conjunto de caracteres.
+    '''
+    ranges = []
+    for code in sorted(imap(ord, chars)):
+        if ranges and ranges[-1][1] == code-1:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+    return u"".join(re.escape(unichr(first)) if first == last else u"%s-%s" % (re.escape(unichr(first)), re.escape(unichr(last)))
+                    for first, last in ranges)
+
+def build_translation_table(sepper):
+    '''
+    Tabla de traducción de slugify para todos los caracteres del plano básico.
+    '''
+    return {
+        ord(i): u" " if i in sepper else u"".join(ifilterfalse(sepper.__contains__, normalize("NFKD", i.lower())))
+        for i in imap(unichr, chain(xrange(0xD800), xrange(0xE000, 0x10000)))
+        }
+
+def build_tables():
+    sepper = build_sepper()
+    return {"SEPPER": sepper,
+            "SEPPER_CLASS": char_class(sepper),
+            "TRANSLATION_TABLE": build_translation_table(sepper)}
+
+# tablas derivadas de la base de datos unicode, se guardan en disco para no calcularlas en cada proceso
+_tables = load_tables("splitter", (__file__,), build_tables)
+SEPPER = _tables["SEPPER"]
+SEPPER_CLASS = _tables["SEPPER_CLASS"]
+TRANSLATION_TABLE = _tables["TRANSLATION_TABLE"]
+ASCII_SEPPER_CLASS = char_class(c for c in SEPPER if c < u"\x80").encode("ascii")
+
+sepper_re = re.compile(u"[%s]" % SEPPER_CLASS)
+# palabras y separadores, agrupando los separadores iguales consecutivos
+parts_re = re.compile(u"([%s])\\1*|[^%s]+" % (SEPPER_CLASS, SEPPER_CLASS))
+# en textos sin decodificar solo se reconocen los separadores ASCII
+bytes_parts_re = re.compile("([%s])\\1*|[^%s]+" % (ASCII_SEPPER_CLASS, ASCII_SEPPER_CLASS))
+
 def seppersplit(text):
     '''
     Separa texto por separadores
@@ -41,6 +83,9 @@ def seppersplit(text):
 
 def proper_case(expr):
     ''' Separa palabras por mayusculas o numeros de más de 2 digitos. '''
+    # sin numeros ni mayusculas tras la primera letra no hay nada que separar
+    if expr.isalpha() and expr[1:].islower():
+        return expr
     mode = "^"
     start = 0
     result = []
@@ -63,26 +108,14 @@ def proper_case(expr):
     return space_join(result)
 
 def group_parts(phrase):
-    last_char = None
-    acum = []
-    for char in phrase:
-        if char in SEPPER:
-            if acum:
-                yield empty_join(acum)
-                last_char = None
-                acum = []
-            if last_char!=char:
-                last_char = char
-                yield char
-        else:
-            acum.append(char)
-    if acum:
-        yield empty_join(acum)
-
-TRANSLATION_TABLE = {
-    ord(i): u" " if i in SEPPER else u"".join(ifilterfalse(SEPPER.__contains__, normalize("NFKD", i.lower())))
-    for i in imap(unichr, chain(xrange(0xD800), xrange(0xE000, 0x10000)))
-    }
+    '''
+    Separa texto en palabras y separadores, sin repetir separadores iguales consecutivos.
+
+    >>> list(group_parts(u"Hola,, soy un--texto"))
+    [u'Hola', u',', u' ', u'soy', u' ', u'un', u'-', u'texto']
+    '''
+    for match in (bytes_parts_re if isinstance(phrase, str) else parts_re).finditer(phrase):
+        yield match.group(1) or match.group(0)
 
 def slugify(text):
     try:
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+'''
+    Cache en memoria con refresco en segundo plano.
+'''
+import threading
+import cPickle as pickle
+from time import time
+
+from . import LRUCache, logging
+
+class WarmCache(object):
+    '''
+    Cache de resultados que se sirven desde memoria mientras se refrescan.
+
+    Cada entrada es valida durante un tiempo y despues se sigue sirviendo caducada
+    durante otro tiempo mientras el gestor de eventos la refresca en segundo plano,
+    de modo que las peticiones mas frecuentes no esperan nunca a la carga.
+    Los valores se guardan serializados, cada peticion recibe su propia copia.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._reset_stats()
+
+    def init_app(self, app, eventmanager, profiler, prefix):
+        '''
+        Inicializa el cache a partir de la configuración de la aplicación.
+
+        @type prefix: str
+        @param prefix: prefijo de los datos de profiling
+        '''
+        self.app = app
+        self.eventmanager = eventmanager
+        self.profiler = profiler
+        self.prefix = prefix
+        self.timeout = app.config["RESULTS_CACHE_TIMEOUT"]
+        self.stale_timeout = app.config["RESULTS_CACHE_STALE_TIMEOUT"]
+        self.entries = LRUCache(app.config["RESULTS_CACHE_SIZE"])
+        self.enabled = app.config["CACHE_SEARCHES"]
+        eventmanager.interval(app.config["SERVICE_SEARCH_PROFILE_INTERVAL"], self.save_profile_info)
+
+    def _reset_stats(self):
+        self.hits = self.stale_hits = self.misses = self.refreshes = self.errors = 0
+        self.staleness = 0.
+
+    def get(self, key, loader, hargs=(), hkwargs=None, validate=None):
+        '''
+        Obtiene un valor del cache o lo carga si no esta.
+
+        @type key: hashable
+        @param key: clave del valor
+
+        @type loader: callable
+        @param loader: funcion que carga el valor a partir de hargs
+
+        @type hkwargs: dict
+        @param hkwargs: parametros con nombre para la carga desde la peticion actual, no se usan al refrescar
+
+        @type validate: callable
+        @param validate: funcion que indica si un valor recien cargado se puede guardar
+        '''
+        if not self.enabled:
+            return loader(*hargs, **(hkwargs or {}))
+
+        entry = self.entries.get(key)
+        if entry:
+            data, expires = entry
+            age = time()-expires
+            if age<0:
+                self.hits += 1
+                return pickle.loads(data)
+            if age<self.stale_timeout:
+                self.stale_hits += 1
+                self.staleness += age
+                self._schedule_refresh(key, loader, hargs, validate)
+                return pickle.loads(data)
+
+        self.misses += 1
+        value = loader(*hargs, **(hkwargs or {}))
+        self._store(key, value, validate)
+        return value
+
+    def _store(self, key, value, validate):
+        if validate is None or validate(value):
+            self.entries.set(key, (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time()+self.timeout))
+
+    def _schedule_refresh(self, key, loader, hargs, validate):
+        # solo se programa un refresco por clave
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        self.eventmanager.timeout(0, self._refresh, hargs=(key, loader, hargs, validate))
+
+    def _refresh(self, key, loader, hargs, validate):
+        try:
+            with self.app.app_context():
+                self._store(key, loader(*hargs), validate)
+            self.refreshes += 1
+        except BaseException as e:
+            self.errors += 1
+            logging.exception(e)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def save_profile_info(self):
+        entries_stats = self.entries.stats(reset=True)
+        prefix = self.prefix
+        profiling_info = {prefix+"hits": self.hits, prefix+"stale_hits": self.stale_hits, prefix+"misses": self.misses,
+                          prefix+"refreshes": self.refreshes, prefix+"errors": self.errors, prefix+"size": entries_stats["size"],
+                          prefix+"staleness": self.staleness/self.stale_hits if self.stale_hits else 0}
+        self._reset_stats()
+        self.profiler.save_data(profiling_info)
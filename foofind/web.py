@@ -29,7 +29,7 @@ from foofind.utils.webassets_filters import JsSlimmer, CssSlimmer
 from foofind.utils import u, logging
 from foofind.forms.files import SearchForm
 from foofind.utils.exceptions import allerrors, get_error_code_information
-from foofind.utils.bots import is_search_bot, is_full_browser, check_rate_limit
+from foofind.utils.bots import is_search_bot, is_full_browser, check_rate_limit, ratelimiter
 
 try:
     from uwsgidecorators import postfork
@@ -222,7 +222,7 @@ def create_app(config=None, debug=False):
     filesdb.init_app(app)
     usersdb.init_app(app)
     pagesdb.init_app(app)
-    feedbackdb.init_app(app)
+    feedbackdb.init_app(app, eventmanager)
     configdb.init_app(app)
     entitiesdb.init_app(app)
     downloadsdb.init_app(app)
@@ -237,12 +237,24 @@ def create_app(config=None, debug=False):
             # Fallback inicio del eventManager
             eventmanager.start()
 
+    # Limite de peticiones
+    ratelimiter.init_app(app, eventmanager)
+
     # Taming
     taming.init_app(app)
 
     # Profiler
     profiler.init_app(app, feedbackdb)
 
+    # Cache de resultados de busquedas
+    resultscache.init_app(app, eventmanager, profiler, "rc_")
+
+    # Estadisticas del cargador de entidades
+    eventmanager.interval(app.config["SERVICE_SEARCH_PROFILE_INTERVAL"], entitiesdb.save_profile_info, hargs=(profiler,))
+
+    # Estadisticas de la cola de escritura de feedback
+    eventmanager.interval(app.config["SERVICE_SEARCH_PROFILE_INTERVAL"], feedbackdb.save_queue_stats, hargs=(profiler,))
+
     eventmanager.once(searchd.init_app, hargs=(app, filesdb, entitiesdb, profiler))
 
     # Refresco de conexiones